@@ -0,0 +1,417 @@
+"""OCR BIFタグ付けツールの主な処理のベンチマーク。
+
+    python benchmarks/bench_core.py                    # 計測して baseline.json と比較する
+    python benchmarks/bench_core.py --save-baseline    # 今回の結果を基準値として保存する
+    xvfb-run -a python benchmarks/bench_core.py --ui   # 画面が必要な処理(キャンバス・表)も計測する
+
+OCRはPaddleOCRの代わりに合成した結果を返すスタブを使うので、paddleocrは不要。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr_tagger  # noqa: E402
+from ocr_tagger import (AnnotationJournal, BoxStore, ImagePyramid, OCRCache, OCREngine, PageModel,  # noqa: E402
+                        PreTagger, DEFAULT_PRETAG_RULES, fit_scale, normalize_ocr_lines, ocr_lines_to_items)
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PAGE_SIZE = (2480, 3508)  # A4・300dpi
+CANVAS_SIZE = (800, 600)
+BOX_COUNTS = (100, 1000, 10000)
+MEGAPIXELS = (1, 10, 100)
+TEXT_CHARS = "あいうえおかきくけこさしすせそ山田川本中村佐藤鈴木高橋請求書番号合計金額"
+TEXT_SAMPLES = ("03-1234-5678", "〒100-0001", "東京都千代田区丸の内", "株式会社テスト", "12,345")
+
+
+def make_lines(count, width=PAGE_SIZE[0], height=PAGE_SIZE[1], seed=0):
+    # PaddleOCRの生の結果と同じ形(四隅の座標と(文字列, スコア))の行を、行単位で並べて作る
+    rng = random.Random(seed)
+    per_row = max(1, int(count ** 0.5 * width / height) + 1)
+    rows = (count + per_row - 1) // per_row
+    cell_w = width / per_row
+    cell_h = height / rows
+    lines = []
+    for i in range(count):
+        row, col = divmod(i, per_row)
+        x1 = col * cell_w + rng.uniform(0, cell_w * 0.1)
+        y1 = row * cell_h + rng.uniform(0, cell_h * 0.1)
+        x2 = x1 + rng.uniform(cell_w * 0.4, cell_w * 0.85)
+        y2 = y1 + rng.uniform(cell_h * 0.4, cell_h * 0.85)
+        if rng.random() < 0.1:
+            text = rng.choice(TEXT_SAMPLES)
+        else:
+            text = "".join(rng.choice(TEXT_CHARS) for _ in range(rng.randint(2, 12)))
+        lines.append([[[x1, y1], [x2, y1], [x2, y2], [x1, y2]], (text, rng.uniform(0.5, 1.0))])
+    return lines
+
+
+def make_items(count, seed=0):
+    return ocr_lines_to_items(make_lines(count, seed=seed))
+
+
+def make_image(megapixels, seed=0):
+    from PIL import Image
+    width = int((megapixels * 1e6 * PAGE_SIZE[0] / PAGE_SIZE[1]) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    noise = Image.effect_noise((width, height), 64)  # 乱数の画素はPNGで圧縮されないので最悪の場合に近い
+    return Image.merge("RGB", (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise.transpose(Image.FLIP_TOP_BOTTOM)))
+
+
+class StubPaddleOCR:
+    # PaddleOCR.ocrの代わり。画像の内容によらず合成した行を返す
+    def __init__(self, count, delay=0.0):
+        self.lines = make_lines(count)
+        self.delay = delay
+
+    def ocr(self, image, cls=True):
+        if self.delay:
+            time.sleep(self.delay)
+        return [self.lines]
+
+
+def stub_engine(count, cache=None, delay=0.0):
+    engine = OCREngine(cache=cache)
+    engine._engine = StubPaddleOCR(count, delay)
+    engine.startup_time = 0.0
+    return engine
+
+
+def timed(func, repeat, setup=None, batch=1):
+    # 1回あたりの所要時間(秒)のリスト。setupの時間は含めない
+    # 数μsで終わる処理はタイマーの精度やばらつきに埋もれるので、batch回まとめて計って平均を1件とする
+    samples = []
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            for _ in range(batch):
+                func()
+        else:
+            arg = setup()
+            start = time.perf_counter()
+            func(arg)
+        samples.append((time.perf_counter() - start) / batch)
+    return samples
+
+
+def bench_ocr_parse(count):
+    lines = make_lines(count)
+    raw = [[[box, list(text_score)] for box, text_score in lines]]
+    return timed(lambda: BoxStore.from_items(ocr_lines_to_items(normalize_ocr_lines(raw))), 20)
+
+
+def bench_ocr_engine(count):
+    # スタブのエンジンでOCREngine.ocrを通す(キャッシュなし)
+    engine = stub_engine(count)
+    return timed(lambda: engine.ocr("unused.png"), 20)
+
+
+def bench_ocr_cache_hit(megapixels):
+    # キャッシュのキーは画像ファイル全体のハッシュなので、画像の大きさに比例する
+    path = os.path.join(tempfile.mkdtemp(), "page.png")
+    make_image(megapixels).save(path, compress_level=1)
+    engine = stub_engine(1000, cache=OCRCache(os.path.join(os.path.dirname(path), "cache")))
+    engine.ocr(path)
+    return timed(lambda: engine.ocr(path), 10)
+
+
+def bench_hit_test(count):
+    model = PageModel()
+    model.set_boxes(BoxStore.from_items(make_items(count)))
+    rng = random.Random(1)
+    points = [(rng.uniform(0, PAGE_SIZE[0]), rng.uniform(0, PAGE_SIZE[1])) for _ in range(20000)]
+    it = iter(points)
+    return timed(lambda: model.hit_test(*next(it)), 200, batch=100)
+
+
+def bench_tag_rect(count):
+    # 範囲選択でのタグ付けとUndo
+    model = PageModel()
+    model.set_boxes(BoxStore.from_items(make_items(count)))
+    rng = random.Random(2)
+
+    def run():
+        x = rng.uniform(0, PAGE_SIZE[0] - 400)
+        y = rng.uniform(0, PAGE_SIZE[1] - 400)
+        model.apply_tag(model.query_rect(x, y, x + 400, y + 400), "name")
+        model.undo()
+
+    return timed(run, 50, batch=20)
+
+
+def bench_rebuild_index(count):
+    model = PageModel()
+    model.boxes = BoxStore.from_items(make_items(count))
+    return timed(model.rebuild_spatial_index, 10)
+
+
+def bench_save(count):
+    model = PageModel()
+    model.image_path = "page.png"
+    model.set_boxes(BoxStore.from_items(make_items(count)))
+    path = os.path.join(tempfile.mkdtemp(), "page.json")
+    return timed(lambda: model.save(path), 10)
+
+
+def bench_load(count):
+    model = PageModel()
+    model.image_path = "page.png"
+    model.set_boxes(BoxStore.from_items(make_items(count)))
+    path = os.path.join(tempfile.mkdtemp(), "page.json")
+    model.save(path)
+
+    def run():
+        with open(path, "r", encoding="utf-8") as f:
+            PageModel().load_data(json.load(f))
+
+    return timed(run, 10)
+
+
+def bench_journal(count):
+    # 作業ログへの1操作の追記(1秒ごとのflushは含めない)
+    model = PageModel()
+    model.image_path = os.path.join(tempfile.mkdtemp(), "page.png")
+    model.set_boxes(BoxStore.from_items(make_items(count)))
+    journal = AnnotationJournal(model.image_path, os.path.join(os.path.dirname(model.image_path), "journal"))
+    journal.compact(model.snapshot())
+    rng = random.Random(3)
+
+    def run():
+        index = rng.randrange(count)
+        journal.append({"op": "do", "step": model.apply_tag([index], "name")})
+
+    samples = timed(run, 100, batch=50)
+    journal.close()
+    return samples
+
+
+def bench_pretag(count):
+    pretagger = PreTagger(DEFAULT_PRETAG_RULES)
+    items = make_items(count)
+    return timed(lambda boxes: pretagger.apply(boxes), 10, setup=lambda: BoxStore.from_items(items))
+
+
+def bench_pyramid_build(megapixels):
+    image = make_image(megapixels)
+    return timed(lambda: ImagePyramid(image.copy()), 3)
+
+
+def bench_zoom_render(megapixels):
+    # フィット表示付近でのホイール操作1回分(低品質の仮描画と、止まった後の高品質な描画)
+    pyramid = ImagePyramid(make_image(megapixels))
+    base = fit_scale(pyramid.width, pyramid.height, *CANVAS_SIZE)
+    scales = iter([base * (1 + 0.1 * step) for step in range(1, 40)])
+
+    def run():
+        scale = next(scales)
+        pyramid.render(scale, preview=True)
+        pyramid.render(scale)
+
+    return timed(run, 10)
+
+
+def ui_app(count):
+    # 画面が必要な計測用。スタブのOCRエンジンでBIFTaggerを作り、合成したページを表示する
+    import tkinter as tk
+    ocr_tagger.ocr = stub_engine(count)
+    os.chdir(tempfile.mkdtemp())  # 作業ログや索引を一時フォルダに書く
+    path = "page.png"
+    make_image(1).save(path)
+    root = tk.Tk()
+    app = ocr_tagger.BIFTagger(root, prefetch_depth=0)
+    app.pretag_enabled.set(False)
+    app.set_image(path)
+    app.apply_ocr_result(ocr_tagger.ocr.ocr(path))
+    root.update()
+    return root, app
+
+
+def bench_ui_apply_ocr(count):
+    root, app = ui_app(count)
+    result = ocr_tagger.ocr.ocr("page.png")
+
+    def run():
+        app.apply_ocr_result(result)
+        root.update()
+
+    return timed(run, 5)
+
+
+def bench_ui_create_boxes(count):
+    root, app = ui_app(count)
+
+    def run():
+        app.create_box_items()
+        root.update()
+
+    return timed(run, 5)
+
+
+def bench_ui_update_tag_table(count):
+    root, app = ui_app(count)
+
+    def run():
+        app.update_tag_table()
+        root.update()
+
+    return timed(run, 5)
+
+
+def bench_ui_click(count):
+    # クリックでのタグ付け(当たり判定・矩形の色・表の行の更新)
+    root, app = ui_app(count)
+    rng = random.Random(4)
+
+    def run():
+        index = rng.randrange(count)
+        x1, y1, x2, y2 = app.boxes.box(index)
+        app.apply_tag([app.model.hit_test((x1 + x2) / 2, (y1 + y2) / 2)], "name")
+        root.update()
+
+    return timed(run, 100)
+
+
+def bench_ui_zoom(count):
+    root, app = ui_app(count)
+    base = app.scale
+    scales = iter([base * (1 + 0.1 * step) for step in range(1, 40)])
+
+    def run():
+        app.scale = next(scales)
+        app.render_image()
+        app.layout_boxes()
+        root.update()
+
+    return timed(run, 10)
+
+
+def build_cases(quick=False, ui=False):
+    counts = BOX_COUNTS[:2] if quick else BOX_COUNTS
+    sizes = MEGAPIXELS[:2] if quick else MEGAPIXELS
+    cases = []
+    for count in counts:
+        for func in (bench_ocr_parse, bench_ocr_engine, bench_hit_test, bench_tag_rect, bench_rebuild_index,
+                     bench_save, bench_load, bench_journal, bench_pretag):
+            cases.append((f"{func.__name__[6:]}[{count}]", func.__name__, count))
+    for megapixels in sizes:
+        for func in (bench_pyramid_build, bench_zoom_render, bench_ocr_cache_hit):
+            cases.append((f"{func.__name__[6:]}[{megapixels}MP]", func.__name__, megapixels))
+    if ui:
+        for count in counts:
+            for func in (bench_ui_apply_ocr, bench_ui_create_boxes, bench_ui_update_tag_table, bench_ui_click,
+                         bench_ui_zoom):
+                cases.append((f"{func.__name__[6:]}[{count}]", func.__name__, count))
+    return cases
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # macOSはバイト、Linuxはキロバイト
+
+
+def percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def run_case(func_name, param):
+    # 子プロセスで1件だけ実行する。ピークメモリは開始時からの最大常駐サイズの増加分
+    before = peak_rss_mb()
+    samples = sorted(globals()[func_name](param))
+    return {
+        "runs": len(samples),
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p90_ms": percentile(samples, 0.9) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": samples[-1] * 1000,
+        "peak_mb": max(0.0, peak_rss_mb() - before),
+    }
+
+
+def find_regressions(results, baseline, tolerance, min_ms=0.02, min_mb=5.0):
+    # p50とピークメモリが基準値より(割合・絶対値の両方で)大きくなったものを返す
+    # 数μsの処理はtimedのbatchでまとめて計っているので、絶対値の下限は小さくてよい
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["p50_ms"] > base["p50_ms"] * (1 + tolerance) and result["p50_ms"] - base["p50_ms"] > min_ms:
+            regressions.append(f"{name}: p50 {base['p50_ms']:.3f}ms -> {result['p50_ms']:.3f}ms")
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance) + min_mb:
+            regressions.append(f"{name}: peak {base['peak_mb']:.1f}MB -> {result['peak_mb']:.1f}MB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OCR BIFタグ付けツールのベンチマーク")
+    parser.add_argument("-k", "--filter", help="名前にこの文字列を含むものだけ実行する")
+    parser.add_argument("--quick", action="store_true", help="10000矩形・100MPの計測を省く")
+    parser.add_argument("--ui", action="store_true", help="画面が必要な計測も行う(xvfb-runなどで実行)")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="今回の結果で基準値を更新する")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="基準値から悪化を許容する割合")
+    parser.add_argument("-o", "--output", help="結果のJSONの出力先")
+    args = parser.parse_args(argv)
+
+    if args.ui and not (os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin")):
+        print("DISPLAYがないため画面が必要な計測は行いません(xvfb-run -a で実行してください)")
+        args.ui = False
+    cases = [case for case in build_cases(args.quick, args.ui) if not args.filter or args.filter in case[0]]
+
+    results = {}
+    print(f"{'name':<28}{'runs':>6}{'p50(ms)':>11}{'p90(ms)':>11}{'p99(ms)':>11}{'max(ms)':>11}{'peak(MB)':>10}")
+    # 計測ごとに新しいプロセスを使い、メモリのピークや前の計測の影響が混ざらないようにする
+    ctx = multiprocessing.get_context("spawn")
+    for name, func_name, param in cases:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_case, (func_name, param))
+        results[name] = result
+        print(f"{name:<28}{result['runs']:>6}{result['p50_ms']:>11.3f}{result['p90_ms']:>11.3f}"
+              f"{result['p99_ms']:>11.3f}{result['max_ms']:>11.3f}{result['peak_mb']:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"基準値を保存しました: {args.baseline}")
+        return 0
+
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        # --uiの計測は画面のある環境で--save-baselineするまで比較しない
+        print(f"基準値がないため比較しないもの ({len(missing)}件): {', '.join(missing)}")
+    regressions = find_regressions(results, baseline, args.tolerance)
+    if regressions:
+        print(f"基準値より遅く(大きく)なったもの ({len(regressions)}件):")
+        for line in regressions:
+            print("  " + line)
+        return 1
+    if baseline:
+        print("基準値からの悪化はありません")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,1915 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, colorchooser
+from tkinter import filedialog, messagebox, colorchooser, ttk
 from PIL import Image, ImageTk
-from paddleocr import PaddleOCR
+import numpy as np
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import cProfile
+import difflib
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import pstats
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import unicodedata
+
+APP_START_TIME = time.perf_counter()  # 起動時間の計測用
+
+OCR_LANG = 'japan'  # 日本語対応
+OCR_USE_ANGLE_CLS = True
+OCR_WORKERS = 1  # PaddleOCRのインスタンスはスレッドセーフではないため推論は直列化される
+OCR_CACHE_DIR = ".ocr_cache"
+OCR_CACHE_MAX_BYTES = 512 * 1024 * 1024  # キャッシュの上限サイズ(超えたら古いものから削除)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+ZOOM_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 描画済みズーム画像を保持する上限
+ZOOM_PREVIEW_DELAY_MS = 15  # この間に来たホイールイベントはまとめて描画する
+ZOOM_REFINE_DELAY_MS = 250  # ズームが止まってから高品質で描き直すまでの待ち時間
+TILE_SIZE = 512
+TILE_CACHE_SIZE = 64  # キャンバス上に保持するタイルの上限数
+TILED_RENDER_THRESHOLD = 4096 * 4096  # 拡大後の画素数がこれを超えたらタイル描画に切り替える
+LABEL_MIN_SCALE = 0.5  # これより縮小したときは文字列・タグのラベルを表示しない
+SPATIAL_CELL_SIZE = 64  # 当たり判定用の格子のサイズ(元画像の座標系)
+DRAG_THRESHOLD = 4  # これ以上動かしたらクリックではなく範囲選択として扱う
+REGION_OCR_PADDING = 8  # 領域再OCRで選択範囲の周りに含める余白(元画像の画素数)
+REGION_OCR_MIN_SIDE = 96  # 切り出した画像の短辺がこれより小さければ拡大してからOCRする
+REGION_OCR_MAX_UPSCALE = 3.0  # 領域再OCRの拡大率の上限(1.0で拡大しない)
+REGION_OCR_MIN_OVERLAP = 0.5  # 面積のこの割合以上が選択範囲に入る既存の矩形を置き換える
+REGION_OCR_DUPLICATE_OVERLAP = 0.5  # 新しい矩形と、小さい方の面積のこの割合以上重なる既存の矩形も置き換える
+# PaddleOCRは検出時に長辺を960px程度に縮小するので、大きなページは分割してOCRする
+TILED_OCR_MIN_PIXELS = 4000 * 4000  # これより画素数が多いページを分割する(A3・300dpiが約1700万画素)
+TILED_OCR_TILE_SIZE = 1280
+TILED_OCR_OVERLAP = 160  # タイルどうしの重なり(文字の高さより大きくする)
+TILED_OCR_WORKERS = max(1, min(4, os.cpu_count() or 1))  # ワーカーごとにモデルを読み込むのでメモリに注意
+TILED_OCR_CONTAINMENT = 0.8  # 面積のこの割合以上がもう一方に入っていれば同じ矩形とみなす
+TILED_OCR_TEXT_SIMILARITY = 0.6  # 短い方の文字列のこの割合以上が一致すれば同じ文字列とみなす
+TILED_OCR_LINE_OVERLAP = 0.6  # 境界で切れた断片どうしの、行の高さ方向の重なりの割合
+TILED_OCR_EDGE_MARGIN = 8  # タイルの辺からこの距離(px)以内で終わる矩形は、辺で切れたものとみなす
+PAGE_HASH_SIZE = 8  # 差分ハッシュの一辺(8で64ビット)
+PAGE_HASH_MAX_DISTANCE = 5  # ハッシュのハミング距離がこれ以下なら同じページの再スキャンとみなす
+TAG_TRANSFER_MIN_IOU = 0.5  # 類似ページからタグを引き継ぐときに対応づける矩形の重なりの下限
+PREFETCH_DEPTH = 3  # 作業フォルダで先読みする枚数
+PREFETCH_MAX_BYTES = 1024 * 1024 * 1024  # 先読みしたデコード済み画像の合計の上限
+JOURNAL_DIR = ".ocr_tagger_journal"  # 画像ごとの作業ログ(自動保存)の保存先
+JOURNAL_FLUSH_MS = 1000  # この間隔でまとめてディスクに書き出す(クラッシュ時に失うのは最大この時間分)
+JOURNAL_COMPACT_OPS = 500  # この件数ごとにログをスナップショットへまとめる
+JOURNAL_HISTORY_LIMIT = 100  # スナップショットに残すUndo/Redoの件数(これより古い操作は復元後は戻せない)
+ANNOTATION_DB = "annotations.db"  # 保存済みJSONを横断検索するための索引
+PERF_MAX_EVENTS = 100000  # トレースとして保持する計測結果の上限(古いものから捨てる)
+PERF_OVERLAY_MS = 500  # 計測値の表示を更新する間隔
+PRETAG_RULES_FILE = "pretag_rules.json"
+
+# 自動タグ付けの既定ルール(上にあるものが優先)。pretag_rules.jsonがあればそちらを使う
+DEFAULT_PRETAG_RULES = [
+    {"tag": "Phone", "patterns": [r"(?:TEL|Tel|電話)?[:：]?\s*0\d{1,4}[-(]\d{1,4}[-)]\d{3,4}",
+                                  r"\+81[-\s]?\d{1,4}[-\s]?\d{1,4}[-\s]?\d{3,4}"]},
+    {"tag": "address", "patterns": [r"〒\s*\d{3}-?\d{4}",
+                                    r"(?:東京都|北海道|京都府|大阪府|\S{2,3}県)\S*?[市区町村郡]"]},
+    {"tag": "ORG", "patterns": [r"株式会社|有限会社|合同会社|合資会社|一般社団法人|一般財団法人|\(株\)|\(有\)"]},
+    {"tag": "Number", "patterns": [r"^(?=.*\d)[\d,.\-/]+$"]},  # 記号だけの行("-"や"...")は除く
+]
+
+
+def paddleocr_version():
+    # paddleをimportせずにバージョンだけ取得する
+    from importlib import metadata
+    try:
+        return metadata.version("paddleocr")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def normalize_ocr_lines(result):
+    # PaddleOCRの結果(result[0])をJSONに保存できる形(floatとstrのみ)に変換する
+    lines = []
+    for box, (text, score) in (result[0] or []):
+        lines.append([[[float(x), float(y)] for x, y in box], [str(text), float(score)]])
+    return lines
+
+
+def ocr_lines_to_items(lines):
+    # OCR結果の四角形を左上・右下の矩形に変換し、保存形式の項目にする(タグは全て"O")
+    items = []
+    for box, (text, score) in lines:
+        x1 = min(point[0] for point in box)  # x座標の最小値
+        y1 = min(point[1] for point in box)  # y座標の最小値
+        x2 = max(point[0] for point in box)  # x座標の最大値
+        y2 = max(point[1] for point in box)  # y座標の最大値
+        items.append({
+            "text": text,
+            "box": [[x1, y1], [x2, y2]],
+            "tag": "O",
+            "score": score,  # スコアを保存
+        })
+    return items
+
+
+def build_save_data(image_path, scale, items):
+    # save_tagsと同じJSON形式を組み立てる
+    data = {
+        "image_path": image_path,
+        "scale": scale,  # スケール情報を保存
+        "items": []
+    }
+    for item in items:
+        box = item["box"]
+        x1, y1 = box[0]  # 左上の座標
+        x2, y2 = box[1]  # 右下の座標
+        if x1 > x2 or y1 > y2:  # 座標が逆転している場合を修正
+            x1, x2 = min(x1, x2), max(x1, x2)
+            y1, y2 = min(y1, y2), max(y1, y2)
+        data["items"].append({
+            "text": item["text"],
+            "box": [[x1, y1], [x2, y2]],  # 左上と右下の形式に修正
+            "tag": item["tag"],
+            "score": item["score"]  # スコアを保存
+        })
+    return data
+
+
+def check_save_data(data):
+    # save_tags形式のJSONか確かめる。同じフォルダにある設定ファイルなどはValueErrorにする
+    if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+        raise ValueError("save_tags形式のJSONではありません")
+    for item in data["items"]:
+        try:
+            (x1, y1), (x2, y2) = item["box"]
+            valid = (isinstance(item["text"], str) and isinstance(item["tag"], str)
+                     and all(isinstance(v, (int, float)) for v in (x1, y1, x2, y2)))
+        except (KeyError, TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise ValueError(f"矩形の項目が不正です: {item!r}")
+    return data
+
+
+def write_json_atomic(path, data, indent=2):
+    # 書き込み途中で止まっても壊れたファイルが残らないように一時ファイルから置き換える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+
+class PerfStats:
+    # 処理ごとの所要時間を集計し、直近の計測結果をトレースとして保持する。ワーカースレッドからも使える
+    def __init__(self, max_events=PERF_MAX_EVENTS):
+        self.stats = {}  # 名前 -> [回数, 合計秒, 直近の秒, 最大の秒]
+        self.events = deque(maxlen=max_events)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **fields):
+        # withの中で返された辞書に件数などを追加すると、トレースに一緒に記録される
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(name, time.perf_counter() - start, start, **fields)
+
+    def timed(self, name):
+        # メソッド全体を計測するデコレータ
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, elapsed, start=None, **fields):
+        if start is None:
+            start = time.perf_counter() - elapsed
+        event = {"t": round(start - self._start, 6), "name": name, "ms": round(elapsed * 1000, 3),
+                 "thread": threading.current_thread().name}
+        event.update(fields)
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = elapsed
+            stat[3] = max(stat[3], elapsed)
+            self.events.append(event)
+
+    def summary(self):
+        # (名前, 回数, 直近のms, 平均のms, 最大のms)を合計時間の長い順に返す
+        with self._lock:
+            rows = [(name, count, last * 1000, total / count * 1000, longest * 1000)
+                    for name, (count, total, last, longest) in self.stats.items()]
+        rows.sort(key=lambda row: -row[1] * row[3])
+        return rows
+
+    def export(self, path):
+        # 1行1計測のJSONL。最後に集計結果を1行加える
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.write(json.dumps({"name": "summary", "stats": [
+                {"name": name, "count": count, "last_ms": round(last, 3), "avg_ms": round(avg, 3),
+                 "max_ms": round(longest, 3)} for name, count, last, avg, longest in self.summary()]},
+                ensure_ascii=False) + "\n")
+        return len(events)
+
+
+perf = PerfStats()
+
+
+class BoxStore:
+    # OCR矩形を列ごとのnumpy配列で持つ。タグは小さな整数に、文字列はinternして保持する
+    # 絞り込み・タグの一括変更・拡大縮小は列全体への配列演算で行う
+    COLUMNS = (
+        ("x1", np.float64), ("y1", np.float64), ("x2", np.float64), ("y2", np.float64),
+        ("scores", np.float64),
+        ("tag_ids", np.uint16),
+        # キャンバスのitem id(0は未作成)
+        ("rect_ids", np.uint32), ("text_ids", np.uint32), ("tag_item_ids", np.uint32),
+    )
+
+    def __init__(self):
+        self.tag_names = []  # タグ番号 -> タグ名
+        self.tag_index = {}  # タグ名 -> タグ番号
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.zeros(0, dtype))
+        self.texts = []
+
+    @classmethod
+    def from_items(cls, items):
+        store = cls()
+        store.extend(items)
+        return store
+
+    def extend(self, items):
+        # 配列の連結は1回で済ませる(1件ずつ足すと全体のコピーが毎回起きる)
+        items = list(items)
+        if not items:
+            return
+        coords = np.array([[item["box"][0][0], item["box"][0][1], item["box"][1][0], item["box"][1][1]]
+                           for item in items], dtype=np.float64)
+        # 座標が逆転している場合はここで左上・右下にそろえる
+        columns = {
+            "x1": np.minimum(coords[:, 0], coords[:, 2]),
+            "y1": np.minimum(coords[:, 1], coords[:, 3]),
+            "x2": np.maximum(coords[:, 0], coords[:, 2]),
+            "y2": np.maximum(coords[:, 1], coords[:, 3]),
+            "scores": np.array([item.get("score", 0.0) for item in items], dtype=np.float64),  # スコアのデフォルトは0.0
+            "tag_ids": np.array([self.intern_tag(item["tag"]) for item in items], dtype=np.uint16),
+        }
+        for name, dtype in self.COLUMNS:
+            added = columns.get(name)
+            if added is None:
+                added = np.zeros(len(items), dtype)
+            setattr(self, name, np.concatenate((getattr(self, name), added)))
+        self.texts.extend(sys.intern(item["text"]) for item in items)
+
+    def reset(self, items):
+        # 矩形をまるごと入れ替える(タグ番号の対応はそのまま使う)
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.zeros(0, dtype))
+        self.texts.clear()
+        self.extend(items)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def intern_tag(self, tag):
+        tag_id = self.tag_index.get(tag)
+        if tag_id is None:
+            tag_id = len(self.tag_names)
+            self.tag_names.append(tag)
+            self.tag_index[tag] = tag_id
+        return tag_id
+
+    def append(self, text, x1, y1, x2, y2, tag="O", score=0.0):
+        self.extend([{"text": text, "box": [[x1, y1], [x2, y2]], "tag": tag, "score": score}])
+        return len(self.texts) - 1
+
+    def tag(self, index):
+        return self.tag_names[self.tag_ids[index]]
+
+    def set_tag(self, index, tag):
+        self.tag_ids[index] = self.intern_tag(tag)
+
+    def set_text(self, index, text):
+        self.texts[index] = sys.intern(text)
+
+    def box(self, index):
+        return self.x1[index], self.y1[index], self.x2[index], self.y2[index]
+
+    def boxes(self):
+        # 全矩形の(x1, y1, x2, y2)をPythonの数値で返す。1件ずつ取り出すより速い
+        return zip(self.x1.tolist(), self.y1.tolist(), self.x2.tolist(), self.y2.tolist())
+
+    def area(self, index):
+        return (self.x2[index] - self.x1[index]) * (self.y2[index] - self.y1[index])
+
+    def item(self, index):
+        # save_tagsと同じ形式の辞書
+        return {
+            "text": self.texts[index],
+            "box": [[float(self.x1[index]), float(self.y1[index])], [float(self.x2[index]), float(self.y2[index])]],
+            "tag": self.tag(index),
+            "score": float(self.scores[index]),
+        }
+
+    def items(self):
+        tag_names = self.tag_names
+        for text, (x1, y1, x2, y2), tag_id, score in zip(self.texts, self.boxes(), self.tag_ids.tolist(),
+                                                          self.scores.tolist()):
+            yield {"text": text, "box": [[x1, y1], [x2, y2]], "tag": tag_names[tag_id], "score": score}
+
+    def find(self, tag=None, min_score=None, max_score=None):
+        # 条件に合う矩形の番号をまとめて返す
+        mask = np.ones(len(self), dtype=bool)
+        if tag is not None:
+            tag_id = self.tag_index.get(tag)
+            if tag_id is None:
+                return []
+            mask &= self.tag_ids == tag_id
+        if min_score is not None:
+            mask &= self.scores >= min_score
+        if max_score is not None:
+            mask &= self.scores <= max_score
+        return np.flatnonzero(mask).tolist()
+
+    def retag(self, indices, tag):
+        # 戻り値は(番号, 変更前のタグ番号)のリストで、そのままUndoに使える
+        tag_id = self.intern_tag(tag)
+        indices = np.asarray(indices, dtype=np.intp)
+        old_tag_ids = self.tag_ids[indices]
+        self.tag_ids[indices] = tag_id
+        return list(zip(indices.tolist(), old_tag_ids.tolist()))
+
+    def retag_all(self, old_tag, new_tag):
+        # あるタグの矩形をすべて別のタグに付け替える
+        return self.retag(self.find(tag=old_tag), new_tag)
+
+    def scale(self, scale_x, scale_y=None):
+        # 全矩形の座標をまとめて拡大・縮小する
+        if scale_y is None:
+            scale_y = scale_x
+        self.x1 *= scale_x
+        self.x2 *= scale_x
+        self.y1 *= scale_y
+        self.y2 *= scale_y
+
+    def nbytes(self):
+        return (sum(getattr(self, name).nbytes for name, _ in self.COLUMNS)
+                + sum(sys.getsizeof(t) for t in set(self.texts)))
+
+
+def apply_step(boxes, step, reverse=False):
+    # stepは{"tags": [[番号, 変更前, 変更後], ...], "texts": [...]}。reverse=Trueで元に戻す
+    # 矩形の追加・削除は{"replace": [[[番号, 削除した項目], ...], 末尾に追加した項目]}。変わった矩形だけを持つ
+    if "replace" in step:
+        removed, added = step["replace"]
+        items = list(boxes.items())
+        if reverse:
+            items = items[:len(items) - len(added)]
+            for index, item in removed:  # 番号の小さい順に元の位置へ戻す
+                items.insert(index, item)
+        else:
+            dropped = {index for index, _ in removed}
+            items = [item for index, item in enumerate(items) if index not in dropped] + list(added)
+        boxes.reset(items)
+        return list(range(len(boxes)))
+    changed = []
+    for index, old, new in step.get("tags", ()):
+        boxes.set_tag(index, old if reverse else new)
+        changed.append(index)
+    for index, old, new in step.get("texts", ()):
+        boxes.set_text(index, old if reverse else new)
+        changed.append(index)
+    return changed
+
+
+class AnnotationJournal:
+    # 画像ごとの追記専用ログ。変更は1行ずつ追記し、定期的にスナップショットのJSONへまとめる
+    def __init__(self, image_path, journal_dir=JOURNAL_DIR):
+        key = hashlib.sha1(os.path.abspath(image_path).encode("utf-8")).hexdigest()
+        self.snapshot_path = os.path.join(journal_dir, key + ".json")
+        self.log_path = os.path.join(journal_dir, key + ".jsonl")
+        self.journal_dir = journal_dir
+        self.ops_since_compact = 0
+        self.unsaved = False  # 最後の保存(またはページを開いた時点)から変更があるか
+        self._file = None
+        self._dirty = False
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path)
+
+    def has_unsaved_work(self):
+        # 保存していない変更が残っているときだけ復元を勧める
+        try:
+            snapshot, entries = self.load()
+        except (OSError, ValueError):
+            return False
+        return bool(entries) or snapshot.get("unsaved", True)
+
+    def load(self):
+        # スナップショットと、その後に追記された操作を返す
+        with open(self.snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        entries = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break  # クラッシュで途中まで書かれた最後の行は捨てる
+        return snapshot, entries
+
+    def compact(self, snapshot):
+        # 現在の状態をスナップショットに書き出し、ログを空にする
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.close()
+        write_json_atomic(self.snapshot_path, dict(snapshot, unsaved=self.unsaved), indent=None)
+        self._file = open(self.log_path, "w", encoding="utf-8")
+        self.ops_since_compact = 0
+
+    def append(self, entry):
+        if self._file is None:
+            self._file = open(self.log_path, "a", encoding="utf-8")
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._dirty = True
+        self.unsaved = True
+        self.ops_since_compact += 1
+
+    def flush(self):
+        # fsyncは毎回ではなく、タイマーでまとめて行う
+        if self._dirty and self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        self.close()
+        for path in (self.snapshot_path, self.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class PageHashIndex:
+    # ページのハッシュをハミング距離のBK木で持ち、距離が近いものだけをたどって探す
+    def __init__(self):
+        self.root = None  # [ハッシュ, キーのリスト, {距離: 子ノード}]
+        self.count = 0
+
+    def add(self, value, key):
+        self.count += 1
+        if self.root is None:
+            self.root = [value, [key], {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(value ^ node[0]).count("1")
+            if distance == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [key], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance=PAGE_HASH_MAX_DISTANCE):
+        # (距離, キー)を近い順に返す
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = bin(value ^ node[0]).count("1")
+            if distance <= max_distance:
+                found.extend((distance, key) for key in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda entry: entry[0])
+        return found
+
+
+class AnnotationIndex:
+    # save_tags形式のJSONを取り込むSQLiteの索引。更新時刻とサイズが変わったファイルだけ取り込み直す
+    def __init__(self, db_path=ANNOTATION_DB):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                json_path TEXT UNIQUE NOT NULL,
+                image_path TEXT,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS boxes (
+                id INTEGER PRIMARY KEY,
+                file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                idx INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                score REAL NOT NULL,
+                x1 REAL, y1 REAL, x2 REAL, y2 REAL
+            );
+            CREATE INDEX IF NOT EXISTS boxes_file ON boxes(file_id);
+            CREATE INDEX IF NOT EXISTS boxes_tag_score ON boxes(tag, score);
+            CREATE TABLE IF NOT EXISTS page_hashes (
+                file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+                hash TEXT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL
+            );
+        """)
+        self.fts = self._create_fts()
+        self._hash_index = None  # 初回の類似ページ検索で読み込む
+
+    def _create_fts(self):
+        # trigramトークナイザ(SQLite 3.34以降)なら分かち書きなしで日本語の部分一致を索引で引ける
+        try:
+            self.conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS boxes_fts USING fts5(
+                    text, content='boxes', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS boxes_ai AFTER INSERT ON boxes BEGIN
+                    INSERT INTO boxes_fts(rowid, text) VALUES (new.id, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS boxes_ad AFTER DELETE ON boxes BEGIN
+                    INSERT INTO boxes_fts(boxes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END;
+            """)
+            return True
+        except sqlite3.OperationalError:
+            print("全文検索(FTS5 trigram)が使えないため、部分一致検索はLIKEで行います")
+            return False
+
+    def close(self):
+        self.conn.close()
+
+    def ingest_file(self, json_path, stat=None, page_hash_info=None):
+        # page_hash_infoは(ハッシュ, (幅, 高さ))。省略時は画像があれば読み込んで計算する
+        json_path = os.path.abspath(json_path)
+        stat = stat or os.stat(json_path)
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = check_save_data(json.load(f))  # pretag_rules.jsonやtags.jsonなどは取り込まない
+        image_path = data.get("image_path")
+        if page_hash_info is None and image_path and os.path.exists(image_path):
+            try:
+                page_hash_info = page_hash_file(image_path)
+            except OSError as e:
+                print(f"ハッシュを計算できませんでした: {image_path}: {e}")
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE json_path = ?", (json_path,))
+            file_id = self.conn.execute(
+                "INSERT INTO files (json_path, image_path, mtime, size) VALUES (?, ?, ?, ?)",
+                (json_path, data.get("image_path"), stat.st_mtime, stat.st_size)).lastrowid
+            self.conn.executemany(
+                "INSERT INTO boxes (file_id, idx, text, tag, score, x1, y1, x2, y2) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(file_id, idx, item["text"], item["tag"], item.get("score", 0.0),
+                  item["box"][0][0], item["box"][0][1], item["box"][1][0], item["box"][1][1])
+                 for idx, item in enumerate(data["items"])])
+            if page_hash_info is not None:
+                value, (width, height) = page_hash_info
+                self.conn.execute("INSERT INTO page_hashes (file_id, hash, width, height) VALUES (?, ?, ?, ?)",
+                                  (file_id, f"{value:016x}", width, height))
+        self._hash_index = None
+
+    def ingest_dir(self, root_dir, recursive=True):
+        # 前回から変わったファイルだけ取り込み、消えたファイルは索引から削除する
+        root_dir = os.path.abspath(root_dir)
+        prefix = os.path.join(root_dir, "")
+        known = {path: (mtime, size) for path, mtime, size in self.conn.execute(
+            "SELECT json_path, mtime, size FROM files") if path.startswith(prefix)}
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if not name.lower().endswith(".json"):
+                    continue
+                json_path = os.path.join(dirpath, name)
+                seen.add(json_path)
+                stat = os.stat(json_path)
+                previous = known.get(json_path)
+                if previous == (stat.st_mtime, stat.st_size):
+                    stats["unchanged"] += 1
+                    continue
+                try:
+                    self.ingest_file(json_path, stat)
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    print(f"取り込み失敗: {json_path}: {e}")
+                    stats["failed"] += 1
+                    continue
+                stats["updated" if previous else "added"] += 1
+            if not recursive:
+                break
+        with self.conn:
+            for json_path in set(known) - seen:
+                self.conn.execute("DELETE FROM files WHERE json_path = ?", (json_path,))
+                stats["removed"] += 1
+        self._hash_index = None
+        return stats
+
+    def invalidate_page_hashes(self):
+        # 別の接続で取り込んだ後に呼ぶ。次の類似ページ検索でBK木を作り直す
+        self._hash_index = None
+
+    def similar_pages(self, value, max_distance=PAGE_HASH_MAX_DISTANCE):
+        # (距離, json_path, image_path, 幅, 高さ)を近い順に返す
+        if self._hash_index is None:
+            self._hash_index = PageHashIndex()
+            for file_id, hash_text in self.conn.execute("SELECT file_id, hash FROM page_hashes"):
+                self._hash_index.add(int(hash_text, 16), file_id)
+        matches = []
+        for distance, file_id in self._hash_index.search(value, max_distance):
+            row = self.conn.execute(
+                "SELECT files.json_path, files.image_path, page_hashes.width, page_hashes.height "
+                "FROM files JOIN page_hashes ON page_hashes.file_id = files.id WHERE files.id = ?",
+                (file_id,)).fetchone()
+            if row is not None:
+                matches.append((distance,) + tuple(row))
+        return matches
+
+    def tag_counts(self):
+        return self.conn.execute("SELECT tag, COUNT(*) FROM boxes GROUP BY tag ORDER BY COUNT(*) DESC").fetchall()
+
+    def _where(self, text=None, tag=None, min_score=None, max_score=None):
+        clauses = []
+        params = []
+        if text:
+            if self.fts and len(text) >= 3:
+                clauses.append("boxes.id IN (SELECT rowid FROM boxes_fts WHERE boxes_fts MATCH ?)")
+                params.append('"' + text.replace('"', '""') + '"')
+            else:
+                clauses.append("boxes.text LIKE ?")  # trigramは3文字未満を引けない
+                params.append("%" + text.replace("%", "").replace("_", "") + "%")
+        if tag:
+            clauses.append("boxes.tag = ?")
+            params.append(tag)
+        if min_score is not None:
+            clauses.append("boxes.score >= ?")
+            params.append(min_score)
+        if max_score is not None:
+            clauses.append("boxes.score <= ?")
+            params.append(max_score)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def search(self, text=None, tag=None, min_score=None, max_score=None, limit=1000):
+        # (json_path, image_path, 矩形の番号, テキスト, タグ, スコア)の一覧
+        where, params = self._where(text, tag, min_score, max_score)
+        return self.conn.execute(
+            "SELECT files.json_path, files.image_path, boxes.idx, boxes.text, boxes.tag, boxes.score "
+            "FROM boxes JOIN files ON files.id = boxes.file_id" + where +
+            " ORDER BY files.json_path, boxes.idx LIMIT ?", params + [limit]).fetchall()
+
+    def pages(self, text=None, tag=None, min_score=None, max_score=None, limit=1000):
+        # 条件に合う矩形を含むページと、その件数
+        where, params = self._where(text, tag, min_score, max_score)
+        return self.conn.execute(
+            "SELECT files.json_path, files.image_path, COUNT(*) FROM boxes JOIN files ON files.id = boxes.file_id" +
+            where + " GROUP BY files.id ORDER BY COUNT(*) DESC LIMIT ?", params + [limit]).fetchall()
+
+
+class AhoCorasick:
+    # 多数の語を1回の走査でまとめて照合する。遷移は(ノード, 文字)をキーにした1つの辞書で持つ
+    def __init__(self):
+        self.goto = {}
+        self.fail = array("l", [0])
+        self.out = array("l", [-1])  # そのノードで一致する語の値の最小値(-1は一致なし)
+
+    def add(self, word, value):
+        node = 0
+        for ch in word:
+            child = self.goto.get((node, ch))
+            if child is None:
+                child = len(self.fail)
+                self.goto[(node, ch)] = child
+                self.fail.append(0)
+                self.out.append(-1)
+            node = child
+        if self.out[node] < 0 or value < self.out[node]:
+            self.out[node] = value
+
+    def build(self):
+        # 幅優先で失敗遷移を作り、失敗先の一致結果も引き継ぐ
+        children = {}
+        for (node, ch), child in self.goto.items():
+            children.setdefault(node, []).append((ch, child))
+        queue_ = list(child for _, child in children.get(0, ()))
+        for node in queue_:
+            for ch, child in children.get(node, ()):
+                state = self.fail[node]
+                while state and (state, ch) not in self.goto:
+                    state = self.fail[state]
+                target = self.goto.get((state, ch), 0)
+                self.fail[child] = target if target != child else 0
+                inherited = self.out[self.fail[child]]
+                if inherited >= 0 and (self.out[child] < 0 or inherited < self.out[child]):
+                    self.out[child] = inherited
+                queue_.append(child)
+
+    def search(self, text):
+        # テキスト中に現れる語の値の最小値を返す。見つからなければNone
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        node = 0
+        best = -1
+        for ch in text:
+            while node and (node, ch) not in goto:
+                node = fail[node]
+            node = goto.get((node, ch), 0)
+            value = out[node]
+            if value >= 0 and (best < 0 or value < best):
+                best = value
+                if best == 0:
+                    break
+        return best if best >= 0 else None
+
+
+class PreTagger:
+    # OCR直後に正規表現と辞書(Aho-Corasick)で明らかなものにタグを付ける。対象はタグが"O"の矩形だけ
+    def __init__(self, rules, base_dir="."):
+        self.tags = []
+        self.patterns = []
+        self.automaton = AhoCorasick()
+        self.term_count = 0  # 辞書語の数
+        for rule_index, rule in enumerate(rules):
+            self.tags.append(rule["tag"])
+            patterns = rule.get("patterns", [])
+            self.patterns.append(re.compile("|".join(f"(?:{p})" for p in patterns)) if patterns else None)
+            words = list(rule.get("terms", []))
+            for dictionary in rule.get("dictionaries", []):
+                with open(os.path.join(base_dir, dictionary), "r", encoding="utf-8") as f:
+                    words.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+            for word in words:
+                self.automaton.add(unicodedata.normalize("NFKC", word), rule_index)
+                self.term_count += 1
+        self.automaton.build()
+
+    def summary(self):
+        return f"自動タグ付け: ルール{len(self.tags)}件, 辞書語{self.term_count}件"
+
+    @classmethod
+    def load(cls, path=PRETAG_RULES_FILE):
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(json.load(f), os.path.dirname(os.path.abspath(path)))
+        return cls(DEFAULT_PRETAG_RULES)
+
+    def tag_text(self, text):
+        # 全角数字などをそろえてから照合する。優先度の高いルールから順に見る
+        text = unicodedata.normalize("NFKC", text)
+        dictionary_hit = self.automaton.search(text)
+        last = dictionary_hit if dictionary_hit is not None else len(self.tags)
+        for rule_index in range(last):
+            pattern = self.patterns[rule_index]
+            if pattern is not None and pattern.search(text):
+                return self.tags[rule_index]
+        return self.tags[dictionary_hit] if dictionary_hit is not None else None
+
+    def apply(self, boxes):
+        # 変更した矩形の[番号, 変更前, 変更後]のリストを返す(そのままUndoの1ステップになる)
+        changes = []
+        for index in boxes.find(tag="O"):
+            tag = self.tag_text(boxes.texts[index])
+            if tag is not None:
+                boxes.set_tag(index, tag)
+                changes.append([index, "O", tag])
+        return changes
+
+    def apply_items(self, items):
+        count = 0
+        for item in items:
+            if item["tag"] == "O":
+                tag = self.tag_text(item["text"])
+                if tag is not None:
+                    item["tag"] = tag
+                    count += 1
+        return count
+
+
+class OCRCache:
+    # 画像の内容ハッシュとOCR設定をキーにしたディスクキャッシュ(LRUはファイルの更新時刻で管理)
+    def __init__(self, cache_dir=OCR_CACHE_DIR, max_bytes=OCR_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._total_bytes = None  # 初回書き込み時に計算する
+        self._lock = threading.Lock()
+
+    def make_key(self, path, config):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digest.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                lines = json.load(f)
+            os.utime(entry_path)  # 最近使ったエントリとして更新時刻を進める
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return lines
+
+    def put(self, key, lines):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(lines, f, ensure_ascii=False)
+        os.replace(tmp_path, entry_path)  # 途中まで書かれたファイルを読まないように置き換える
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += os.path.getsize(entry_path)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".json"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue  # 他のプロセスが削除した
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        # 古いものから上限の9割まで削除する
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total -= size
+        self._total_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class OCREngine:
+    # PaddleOCRはモデル読み込みに時間がかかるため、初回使用時(またはバックグラウンド)に生成する
+    def __init__(self, lang=OCR_LANG, use_angle_cls=OCR_USE_ANGLE_CLS, cache=None):
+        self.lang = lang
+        self.use_angle_cls = use_angle_cls
+        self.cache = cache
+        self.startup_time = None  # 初期化にかかった秒数
+        self.error = None
+        self._engine = None
+        self._lock = threading.Lock()
+        self._infer_lock = threading.Lock()
+
+    def is_ready(self):
+        return self._engine is not None
+
+    def get(self):
+        with self._lock:
+            if self._engine is None:
+                start = time.perf_counter()
+                from paddleocr import PaddleOCR  # paddleのimport自体も重いので遅延させる
+                self._engine = PaddleOCR(use_angle_cls=self.use_angle_cls, lang=self.lang)
+                self.startup_time = time.perf_counter() - start
+                print(f"OCRエンジン初期化: {self.startup_time:.2f}秒")
+            return self._engine
+
+    def warmup(self):
+        # UIをブロックしないように別スレッドでモデルを読み込む
+        def run():
+            try:
+                self.get()
+            except Exception as e:
+                self.error = e
+                print("OCRエンジンの初期化に失敗しました:", e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def config(self, cls=True):
+        return {
+            "lang": self.lang,
+            "use_angle_cls": self.use_angle_cls,
+            "cls": cls,
+            "paddleocr": paddleocr_version(),
+        }
+
+    def ocr_image(self, image, cls=True):
+        # PIL画像を直接OCRする(キャッシュは使わない)。PaddleOCRはOpenCVと同じBGRの配列を受け取る
+        array_bgr = np.ascontiguousarray(np.asarray(image.convert("RGB"))[:, :, ::-1])
+        engine = self.get()
+        with self._infer_lock:
+            lines = normalize_ocr_lines(engine.ocr(array_bgr, cls=cls))
+        return [lines]
+
+    def ocr(self, path, cls=True):
+        # 戻り値はPaddleOCRと同じく[result[0]]の形
+        key = None
+        if self.cache is not None:
+            start = time.perf_counter()
+            key = self.cache.make_key(path, self.config(cls))
+            lines = self.cache.get(key)
+            if lines is not None:
+                perf.record("ocr.cache_hit", time.perf_counter() - start, start, boxes=len(lines))
+                return [lines]
+        engine = self.get()
+        with perf.span("ocr.infer") as span:
+            with self._infer_lock:
+                lines = normalize_ocr_lines(engine.ocr(path, cls=cls))
+            span["boxes"] = len(lines)
+        if key is not None:
+            self.cache.put(key, lines)
+        return [lines]
+
+
+ocr = OCREngine(cache=OCRCache())
+
+
+class TiledOCR:
+    # 大きなページを重なりのあるタイルに分け、複数プロセスで並列にOCRしてから矩形をまとめる
+    def __init__(self, engine, workers=TILED_OCR_WORKERS, tile_size=TILED_OCR_TILE_SIZE,
+                 overlap=TILED_OCR_OVERLAP, min_pixels=TILED_OCR_MIN_PIXELS, compare=False, pool=None):
+        self.engine = engine  # 設定・キャッシュ・単一OCRとの比較に使う
+        self.workers = workers
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.min_pixels = min_pixels
+        self.compare = compare  # Trueなら分割しないOCRも実行して速度を比べる
+        self.last_stats = None
+        self._pool = pool
+        self._own_pool = pool is None
+        self._lock = threading.Lock()
+
+    def needs_tiling(self, path):
+        with Image.open(path) as image:  # ヘッダだけ読む
+            width, height = image.size
+        return width * height > self.min_pixels
+
+    def config(self, cls=True):
+        config = self.engine.config(cls)
+        config["tile_size"] = self.tile_size
+        config["overlap"] = self.overlap
+        return config
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                # paddleはforkと相性が悪いのでspawnでワーカーを起動する
+                ctx = multiprocessing.get_context("spawn")
+                self._pool = ctx.Pool(self.workers, initializer=_batch_worker_init,
+                                      initargs=(self.engine.lang, self.engine.use_angle_cls, None))
+            return self._pool
+
+    def ocr(self, path, cls=True):
+        # 戻り値はOCREngine.ocrと同じ[result[0]]の形
+        cache = self.engine.cache
+        key = None
+        if cache is not None:
+            key = cache.make_key(path, self.config(cls))
+            lines = cache.get(key)
+            if lines is not None:
+                return [lines]
+        start = time.perf_counter()
+        with Image.open(path) as image:
+            width, height = image.size
+        tiles = tile_grid(width, height, self.tile_size, self.overlap)
+        tile_items = self.pool().map(_tile_ocr_one, [(path, tile, cls) for tile in tiles])
+        items = merge_tile_items(tile_items, tiles, self.overlap)
+        elapsed = time.perf_counter() - start
+        stats = {
+            "tiles": len(tiles),
+            "workers": self.workers,
+            "raw_boxes": sum(len(t) for t in tile_items),
+            "boxes": len(items),
+            "elapsed": elapsed,
+        }
+        message = (f"分割OCR: {width}x{height} を{len(tiles)}タイル({self.workers}プロセス), "
+                   f"矩形 {stats['raw_boxes']}件 -> {len(items)}件, {elapsed:.2f}秒")
+        if self.compare:
+            single_start = time.perf_counter()
+            with Image.open(path) as image:
+                self.engine.ocr_image(image, cls)
+            stats["single_elapsed"] = time.perf_counter() - single_start
+            stats["speedup"] = stats["single_elapsed"] / elapsed if elapsed > 0 else 0.0
+            message += f" (分割なし {stats['single_elapsed']:.2f}秒, {stats['speedup']:.2f}倍)"
+        print(message)
+        self.last_stats = stats
+        perf.record("ocr.tiled", elapsed, start, **{k: v for k, v in stats.items() if k != "elapsed"})
+        lines = items_to_lines(items)
+        if key is not None:
+            cache.put(key, lines)
+        return [lines]
+
+    def close(self):
+        if self._pool is not None and self._own_pool:
+            self._pool.terminate()
+        self._pool = None
+
+
+class ImagePyramid:
+    # デコード済みの画像と1/2ずつ縮小した画像を保持し、描画済みのズーム画像をLRUで再利用する
+    @perf.timed("decode")
+    def __init__(self, image, min_size=256, max_bytes=ZOOM_CACHE_MAX_BYTES):
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.load()
+        self.width, self.height = image.size
+        self.levels = [image]  # levels[k]は1/2**kの縮小画像
+        while min(self.levels[-1].size) >= min_size * 2:
+            self.levels.append(self.levels[-1].reduce(2))
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+    def scaled_size(self, scale):
+        return (max(1, int(self.width * scale)), max(1, int(self.height * scale)))
+
+    def level_for(self, scale):
+        # 目的の倍率以上で最も小さいレベルから縮小すれば画質を落とさずに済む
+        level = 0
+        while level + 1 < len(self.levels) and 0.5 ** (level + 1) >= scale:
+            level += 1
+        return self.levels[level], 0.5 ** level
+
+    def is_cached(self, scale):
+        return self.scaled_size(scale) in self._cache
+
+    def render(self, scale, preview=False):
+        size = self.scaled_size(scale)
+        cached = self._cache.get(size)
+        if cached is not None:
+            self._cache.move_to_end(size)
+            return cached
+        source, _ = self.level_for(scale)
+        if source.size == size:
+            return source
+        if preview:
+            return source.resize(size, Image.Resampling.NEAREST)  # 操作中のプレビューは速さ優先でキャッシュしない
+        image = source.resize(size, Image.Resampling.LANCZOS)
+        self._cache[size] = image
+        self._cache_bytes += self._image_bytes(image)
+        while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._cache_bytes -= self._image_bytes(old)
+        return image
+
+    def render_region(self, scale, region, preview=False):
+        # regionは拡大後の座標系での(left, top, right, bottom)。その範囲だけを縮小・拡大する
+        source, level_scale = self.level_for(scale)
+        factor = level_scale / scale
+        left, top, right, bottom = region
+        box = (left * factor, top * factor,
+               min(right * factor, source.width), min(bottom * factor, source.height))
+        resample = Image.Resampling.NEAREST if preview else Image.Resampling.LANCZOS
+        return source.resize((right - left, bottom - top), resample, box=box)
+
+    def nbytes(self):
+        return sum(self._image_bytes(level) for level in self.levels) + self._cache_bytes
+
+    @staticmethod
+    def _image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+
+def fit_scale(width, height, canvas_width, canvas_height):
+    return min(canvas_width / width, canvas_height / height)
+
+
+def region_ocr_items(engine, image, region, padding=REGION_OCR_PADDING,
+                     min_side=REGION_OCR_MIN_SIDE, max_upscale=REGION_OCR_MAX_UPSCALE, cls=True):
+    # 指定範囲(元画像の座標系)だけを切り出してOCRし、矩形をページの座標に戻して返す
+    x1, y1, x2, y2 = region
+    left = max(0, int(x1) - padding)
+    top = max(0, int(y1) - padding)
+    right = min(image.width, int(x2 + 0.999) + padding)
+    bottom = min(image.height, int(y2 + 0.999) + padding)
+    if right <= left or bottom <= top:
+        return []
+    crop = image.crop((left, top, right, bottom))
+    upscale = min(max_upscale, max(1.0, min_side / min(crop.size)))
+    if upscale > 1.0:
+        # 小さな文字は拡大した方が検出・認識の精度が上がる
+        crop = crop.resize((round(crop.width * upscale), round(crop.height * upscale)), Image.LANCZOS)
+    items = ocr_lines_to_items(engine.ocr_image(crop, cls)[0])
+    for item in items:
+        (bx1, by1), (bx2, by2) = item["box"]
+        item["box"] = [[bx1 / upscale + left, by1 / upscale + top], [bx2 / upscale + left, by2 / upscale + top]]
+    return items
+
+
+def region_replaced_indices(items, region, new_items, min_overlap=REGION_OCR_MIN_OVERLAP,
+                            duplicate_overlap=REGION_OCR_DUPLICATE_OVERLAP):
+    # 新しい矩形で置き換える既存の矩形の番号(昇順)。選択範囲に大部分が入るものに加えて、
+    # 余白つきで切り出したために選択範囲の外まで検出された新しい矩形と重なるものも置き換える
+    rx1, ry1, rx2, ry2 = region
+    new_boxes = [(x1, y1, x2, y2) for (x1, y1), (x2, y2) in (item["box"] for item in new_items)]
+    replaced = []
+    for index, item in enumerate(items):
+        (x1, y1), (x2, y2) = item["box"]
+        area = (x2 - x1) * (y2 - y1)
+        overlap = max(0.0, min(x2, rx2) - max(x1, rx1)) * max(0.0, min(y2, ry2) - max(y1, ry1))
+        if area > 0 and overlap / area >= min_overlap:
+            replaced.append(index)
+        elif area <= 0 and rx1 <= x1 <= rx2 and ry1 <= y1 <= ry2:
+            replaced.append(index)
+        elif area > 0 and any(_containment((x1, y1, x2, y2), box) >= duplicate_overlap for box in new_boxes):
+            replaced.append(index)
+    return replaced
+
+
+def _containment(a, b):
+    # 重なりの面積を小さい方の矩形の面積で割った値
+    ix = min(a[2], b[2]) - max(a[0], b[0])
+    iy = min(a[3], b[3]) - max(a[1], b[1])
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return ix * iy / smaller if smaller > 0 else 0.0
+
+
+def tile_grid(width, height, tile_size=TILED_OCR_TILE_SIZE, overlap=TILED_OCR_OVERLAP):
+    # ページを重なりのあるタイルに分ける。端のタイルは画像の端にそろえる
+    step = max(1, tile_size - overlap)
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, step))
+        positions.append(length - tile_size)
+        return positions
+
+    return [(left, top, min(width, left + tile_size), min(height, top + tile_size))
+            for top in starts(height) for left in starts(width)]
+
+
+def items_to_lines(items):
+    # 保存形式の項目をPaddleOCRの行の形(四隅の座標と(文字列, スコア))に戻す
+    lines = []
+    for item in items:
+        (x1, y1), (x2, y2) = item["box"]
+        lines.append([[[x1, y1], [x2, y1], [x2, y2], [x1, y2]], [item["text"], item["score"]]])
+    return lines
+
+
+def _text_overlap(a, b):
+    # 短い方の文字列のうち、もう一方と連続して一致する部分の割合
+    if not a or not b:
+        return 1.0
+    match = difflib.SequenceMatcher(None, a, b, autojunk=False).find_longest_match(0, len(a), 0, len(b))
+    return match.size / min(len(a), len(b))
+
+
+def _join_fragments(first, second):
+    # 重なり部分で両方に現れた文字は1回だけにしてつなげる。共通部分がなければ別の文字列なのでNone
+    for size in range(min(len(first), len(second)), 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return None
+
+
+def tile_cut_lines(tiles):
+    # 画像の端ではないタイルの辺。文字列はここで切れる。(右端のx, 下端のy, 左端のx, 上端のy)の集合を返す
+    page_right = max(tile[2] for tile in tiles)
+    page_bottom = max(tile[3] for tile in tiles)
+    return ({tile[2] for tile in tiles if tile[2] < page_right},
+            {tile[3] for tile in tiles if tile[3] < page_bottom},
+            {tile[0] for tile in tiles if tile[0] > 0},
+            {tile[1] for tile in tiles if tile[1] > 0})
+
+
+def _near_cut(value, lines):
+    return any(abs(value - line) <= TILED_OCR_EDGE_MARGIN for line in lines)
+
+
+def _combine_tile_duplicates(a, b, cuts=None):
+    # 別のタイルで検出されたa(大きい方)とbが同じ文字列なら、まとめた項目を返す。別物ならNone
+    # cutsはtile_cut_linesの結果。なければ断片はつなげず、重なりだけで判定する
+    (ax1, ay1), (ax2, ay2) = a["box"]
+    (bx1, by1), (bx2, by2) = b["box"]
+    ix = min(ax2, bx2) - max(ax1, bx1)
+    iy = min(ay2, by2) - max(ay1, by1)
+    if ix <= 0 or iy <= 0:
+        return None
+    b_area = (bx2 - bx1) * (by2 - by1)
+    if b_area <= 0 or ix * iy / b_area >= TILED_OCR_CONTAINMENT:
+        # 一方のタイルでは行全体が、もう一方では端で切れた一部が検出された
+        return a if _text_overlap(a["text"], b["text"]) >= TILED_OCR_TEXT_SIMILARITY else None
+    # タイルの境界で切れた同じ行の断片どうしなら1つにつなげる(縦書きは上から下へ)
+    horizontal = ax2 - ax1 >= ay2 - ay1 and bx2 - bx1 >= by2 - by1
+    if horizontal:
+        cross = iy / min(ay2 - ay1, by2 - by1)
+        first, second = (a, b) if ax1 <= bx1 else (b, a)
+    else:
+        cross = ix / min(ax2 - ax1, bx2 - bx1)
+        first, second = (a, b) if ay1 <= by1 else (b, a)
+    if cross < TILED_OCR_LINE_OVERLAP or cuts is None:
+        return None
+    # 隣り合う別の語をつなげないよう、どちらかがタイルの辺で切れていて、文字列にも共通部分があるときだけ
+    fx2, fy2 = first["box"][1]
+    sx1, sy1 = second["box"][0]
+    if horizontal:
+        cut = _near_cut(fx2, cuts[0]) or _near_cut(sx1, cuts[2])
+    else:
+        cut = _near_cut(fy2, cuts[1]) or _near_cut(sy1, cuts[3])
+    if not cut:
+        return None
+    text = _join_fragments(first["text"], second["text"])
+    if text is None:
+        return None
+    return {
+        "text": text,
+        "box": [[min(ax1, bx1), min(ay1, by1)], [max(ax2, bx2), max(ay2, by2)]],
+        "tag": "O",
+        "score": min(a["score"], b["score"]),
+    }
+
+
+def merge_tile_items(tile_items, tiles=None, overlap=TILED_OCR_OVERLAP):
+    # tile_itemsはタイルごとの項目のリスト。重なり部分で二重に検出された矩形をまとめる
+    # tilesはtile_gridの結果で、境界で切れた断片をつなげるのに使う
+    cuts = tile_cut_lines(tiles) if tiles else None
+    entries = [(tile, item) for tile, items in enumerate(tile_items) for item in items]
+    entries.sort(key=lambda entry: (-(entry[1]["box"][1][0] - entry[1]["box"][0][0])
+                                    * (entry[1]["box"][1][1] - entry[1]["box"][0][1]), -entry[1]["score"]))
+    grid = SpatialGrid(cell_size=max(1, overlap))
+    kept = {}
+    for key, (tile, item) in enumerate(entries):
+        (x1, y1), (x2, y2) = item["box"]
+        merged = False
+        for other_key in grid.query_rect(x1, y1, x2, y2):
+            other_tile, other = kept[other_key]
+            if other_tile == tile:
+                continue  # 同じタイル内の矩形はOCRの結果のまま扱う
+            combined = _combine_tile_duplicates(other, item, cuts)
+            if combined is not None:
+                (cx1, cy1), (cx2, cy2) = combined["box"]
+                grid.update(other_key, cx1, cy1, cx2, cy2)
+                kept[other_key] = (other_tile, combined)
+                merged = True
+                break
+        if not merged:
+            grid.insert(key, x1, y1, x2, y2)
+            kept[key] = (tile, item)
+    items = [item for _, item in kept.values()]
+    items.sort(key=lambda item: (item["box"][0][1], item["box"][0][0]))
+    return items
+
+
+def page_hash(image):
+    # 差分ハッシュ(dHash)。ページ全体を小さく平均化し、横に隣り合う画素の明暗をビットにする
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    small = image.resize((PAGE_HASH_SIZE + 1, PAGE_HASH_SIZE), Image.BOX).convert("L")
+    pixels = small.tobytes()
+    value = 0
+    for row in range(PAGE_HASH_SIZE):
+        offset = row * (PAGE_HASH_SIZE + 1)
+        for col in range(PAGE_HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def page_hash_file(path):
+    # (ハッシュ, 元画像の大きさ)を返す。JPEGは縮小しながらデコードする
+    with Image.open(path) as image:
+        size = image.size
+        image.draft("RGB", (max(1, image.width // 8), max(1, image.height // 8)))
+        return page_hash(image), size
+
+
+def estimate_page_transform(source_items, target_items, source_size, target_size):
+    # 類似ページの座標を新しいページに合わせる(x' = sx * x + tx, y' = sy * y + ty)
+    # 両方のページに1回ずつだけ現れる文字列の矩形を対応点にして最小二乗で求める。足りなければ画像の大きさの比を使う
+    sx = target_size[0] / source_size[0]
+    sy = target_size[1] / source_size[1]
+    transform = (sx, 0.0, sy, 0.0)
+    if not target_items:
+        return transform
+
+    def unique_centers(items):
+        centers = {}
+        for item in items:
+            if len(item["text"]) >= 2:
+                (x1, y1), (x2, y2) = item["box"]
+                centers.setdefault(item["text"], []).append(((x1 + x2) / 2, (y1 + y2) / 2))
+        return {text: points[0] for text, points in centers.items() if len(points) == 1}
+
+    source_centers = unique_centers(source_items)
+    target_centers = unique_centers(target_items)
+    pairs = [(source_centers[text], target_centers[text]) for text in source_centers if text in target_centers]
+    if len(pairs) < 3:
+        return transform
+
+    def fit(points, default_scale):
+        n = len(points)
+        mean_s = sum(s for s, _ in points) / n
+        mean_t = sum(t for _, t in points) / n
+        variance = sum((s - mean_s) ** 2 for s, _ in points)
+        if variance < 1e-6:
+            return default_scale, mean_t - default_scale * mean_s
+        scale = sum((s - mean_s) * (t - mean_t) for s, t in points) / variance
+        return scale, mean_t - scale * mean_s
+
+    sx, tx = fit([(s[0], t[0]) for s, t in pairs], sx)
+    sy, ty = fit([(s[1], t[1]) for s, t in pairs], sy)
+    return sx, tx, sy, ty
+
+
+def transform_items(items, transform):
+    sx, tx, sy, ty = transform
+    moved = []
+    for item in items:
+        (x1, y1), (x2, y2) = item["box"]
+        moved.append(dict(item, box=[[sx * x1 + tx, sy * y1 + ty], [sx * x2 + tx, sy * y2 + ty]]))
+    return moved
+
+
+def transfer_tags(boxes, source_items, min_iou=TAG_TRANSFER_MIN_IOU):
+    # source_itemsは新しいページの座標に合わせた類似ページの項目。タグが"O"の矩形に、
+    # 最もよく重なる矩形のタグを付ける。変更の[番号, 変更前, 変更後]のリストを返す
+    grid = SpatialGrid()
+    for key, item in enumerate(source_items):
+        if item["tag"] != "O":
+            (x1, y1), (x2, y2) = item["box"]
+            grid.insert(key, x1, y1, x2, y2)
+    changes = []
+    for index in boxes.find(tag="O"):
+        x1, y1, x2, y2 = boxes.box(index)
+        area = boxes.area(index)
+        best_iou = min_iou
+        best_tag = None
+        for key in grid.query_rect(x1, y1, x2, y2):
+            sx1, sy1, sx2, sy2 = grid.boxes[key]
+            overlap = max(0.0, min(x2, sx2) - max(x1, sx1)) * max(0.0, min(y2, sy2) - max(y1, sy1))
+            union = area + (sx2 - sx1) * (sy2 - sy1) - overlap
+            iou = overlap / union if union > 0 else 0.0
+            if iou >= best_iou:
+                best_iou = iou
+                best_tag = source_items[key]["tag"]
+        if best_tag is not None:
+            boxes.set_tag(index, best_tag)
+            changes.append([index, "O", best_tag])
+    return changes
+
+
+class PrefetchPipeline:
+    # 作業フォルダの次のN枚について、デコード・フィット表示用の縮小・OCRを先に済ませておく
+    def __init__(self, ocr_executor, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MAX_BYTES, ocr_func=None, watch=None):
+        self.ocr_executor = ocr_executor  # OCRは画面のOCRと同じワーカーに積んで直列に実行する
+        self.ocr_func = ocr_func if ocr_func is not None else ocr.ocr
+        # watch(future, callback)はデコード完了の通知を受け取る側のスレッドに渡す(GUIではUIスレッド)
+        self.watch = watch if watch is not None else (lambda future, callback: future.add_done_callback(callback))
+        self.decode_executor = ThreadPoolExecutor(max_workers=1)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()  # 画像パス -> [デコードのfuture(上限で捨てた後はNone), OCRのfuture]
+
+    @staticmethod
+    def decode(path, canvas_size):
+        pyramid = ImagePyramid(Image.open(path))
+        if canvas_size is not None:
+            pyramid.render(fit_scale(pyramid.width, pyramid.height, *canvas_size))  # フィット表示の画像も作っておく
+        return pyramid
+
+    def prefetch(self, paths, canvas_size=None):
+        # pathsは次に開く順。バッファにない分を投入し、対象外になったものは捨てる
+        # 上限のために画像だけ捨てたページはデコードし直さない(開くときにデコードする)
+        wanted = paths[:self.depth]
+        for path in list(self.pages):
+            if path not in wanted:
+                self.discard(path)
+        for path in wanted:
+            if path not in self.pages:
+                image_future = self.decode_executor.submit(self.decode, path, canvas_size)
+                self.pages[path] = [image_future, self.ocr_executor.submit(self.ocr_func, path, True)]
+                self.watch(image_future, self.on_decoded)
+        self.enforce_budget()
+
+    def on_decoded(self, future):
+        # 投入時点ではサイズが分からないので、デコードが終わるたびに上限を確かめ直す
+        if not future.cancelled():
+            self.enforce_budget()
+
+    def enforce_budget(self):
+        # デコード済みの画像が上限を超えたら、遠いページから画像だけを捨てる
+        # OCRの結果は小さく、やり直すと時間がかかるので残しておく
+        total = 0
+        for entry in list(self.pages.values()):
+            image_future = entry[0]
+            if image_future is None or not image_future.done() or image_future.exception() is not None:
+                continue
+            size = image_future.result().nbytes()
+            if total + size > self.max_bytes:
+                entry[0] = None
+            else:
+                total += size
+
+    def take(self, path):
+        # (デコードのfutureまたはNone, OCRのfuture)。先読みしていなければNone
+        entry = self.pages.pop(path, None)
+        return tuple(entry) if entry is not None else None
+
+    def discard(self, path):
+        image_future, ocr_future = self.pages.pop(path)
+        if image_future is not None:
+            image_future.cancel()
+        ocr_future.cancel()
+
+    def clear(self):
+        for path in list(self.pages):
+            self.discard(path)
+
+    def shutdown(self):
+        self.clear()
+        self.decode_executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TileRenderer:
+    # 表示範囲にかかるタイルだけを描画する。保持するタイル数に上限があるのでズーム倍率によらずメモリは一定
+    def __init__(self, canvas, tile_size=TILE_SIZE, max_tiles=TILE_CACHE_SIZE):
+        self.canvas = canvas
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.scale = None
+        self.tiles = OrderedDict()  # (tx, ty) -> [PhotoImage, キャンバスのitem id, プレビュー画質か]
+
+    def clear(self):
+        for _, item_id, _ in self.tiles.values():
+            self.canvas.delete(item_id)
+        self.tiles.clear()
+        self.scale = None
+
+    def visible_tiles(self, width, height, margin=1):
+        left = self.canvas.canvasx(0)
+        top = self.canvas.canvasy(0)
+        right = self.canvas.canvasx(self.canvas.winfo_width())
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        size = self.tile_size
+        max_tx = (width - 1) // size
+        max_ty = (height - 1) // size
+        tx0 = max(int(left // size) - margin, 0)
+        ty0 = max(int(top // size) - margin, 0)
+        tx1 = min(int(right // size) + margin, max_tx)
+        ty1 = min(int(bottom // size) + margin, max_ty)
+        return [(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+
+    def update(self, pyramid, scale, preview=False):
+        if scale != self.scale:
+            self.clear()  # 倍率が変わったら古いタイルは使えない
+            self.scale = scale
+        width, height = pyramid.scaled_size(scale)
+        visible = self.visible_tiles(width, height)
+        size = self.tile_size
+        for key in visible:
+            tile = self.tiles.get(key)
+            if tile is not None and (preview or not tile[2]):
+                self.tiles.move_to_end(key)
+                continue
+            tx, ty = key
+            region = (tx * size, ty * size, min((tx + 1) * size, width), min((ty + 1) * size, height))
+            photo = ImageTk.PhotoImage(pyramid.render_region(scale, region, preview))
+            if tile is None:
+                item_id = self.canvas.create_image(region[0], region[1], anchor=tk.NW, image=photo,
+                                                   tags=("image", "tile"))
+            else:
+                item_id = tile[1]
+                self.canvas.itemconfig(item_id, image=photo)  # プレビュー画質のタイルを差し替える
+            self.tiles[key] = [photo, item_id, preview]
+            self.tiles.move_to_end(key)
+
+        # 表示範囲外で古いものから捨てる
+        visible_set = set(visible)
+        for key in list(self.tiles):
+            if len(self.tiles) <= self.max_tiles:
+                break
+            if key not in visible_set:
+                _, item_id, _ = self.tiles.pop(key)
+                self.canvas.delete(item_id)
+        self.canvas.tag_lower("tile")
+
+
+class SpatialGrid:
+    # 矩形を一様格子に登録しておき、クリック位置や選択範囲の近くの矩形だけを調べる
+    def __init__(self, cell_size=SPATIAL_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}  # (cx, cy) -> 矩形のキーの集合
+        self.boxes = {}  # キー -> (x1, y1, x2, y2)
+
+    def _cells(self, x1, y1, x2, y2):
+        size = self.cell_size
+        for cx in range(int(x1 // size), int(x2 // size) + 1):
+            for cy in range(int(y1 // size), int(y2 // size) + 1):
+                yield cx, cy
+
+    def insert(self, key, x1, y1, x2, y2):
+        self.boxes[key] = (x1, y1, x2, y2)
+        for cell in self._cells(x1, y1, x2, y2):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        box = self.boxes.pop(key, None)
+        if box is None:
+            return
+        for cell in self._cells(*box):
+            keys = self.cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.cells[cell]
+
+    def update(self, key, x1, y1, x2, y2):
+        self.remove(key)
+        self.insert(key, x1, y1, x2, y2)
+
+    def query_point(self, x, y):
+        size = self.cell_size
+        keys = self.cells.get((int(x // size), int(y // size)), ())
+        return [key for key in keys
+                if self.boxes[key][0] <= x <= self.boxes[key][2] and self.boxes[key][1] <= y <= self.boxes[key][3]]
+
+    def query_rect(self, x1, y1, x2, y2):
+        found = set()
+        for cell in self._cells(x1, y1, x2, y2):
+            found.update(self.cells.get(cell, ()))
+        return [key for key in found
+                if self.boxes[key][0] <= x2 and x1 <= self.boxes[key][2]
+                and self.boxes[key][1] <= y2 and y1 <= self.boxes[key][3]]
+
+
+class TagTable:
+    # ttk.Treeviewで表示するタグ一覧。表示範囲の行だけが描画され、行ごとにウィジェットを作らない
+    # 列名 -> (見出し, 表示する文字列, 並べ替えのキー)。いずれもBoxStoreと行番号を受け取る
+    COLUMN_FORMATS = {
+        "pos": ("X1,Y1", lambda boxes, i: f"({int(boxes.x1[i])}, {int(boxes.y1[i])})",
+                lambda boxes, i: (boxes.y1[i], boxes.x1[i])),
+        "x1": ("X1", lambda boxes, i: f"{boxes.x1[i]:.2f}", lambda boxes, i: boxes.x1[i]),
+        "y1": ("Y1", lambda boxes, i: f"{boxes.y1[i]:.2f}", lambda boxes, i: boxes.y1[i]),
+        "text": ("テキスト", lambda boxes, i: boxes.texts[i], lambda boxes, i: boxes.texts[i]),
+        "tag": ("タグ", lambda boxes, i: boxes.tag(i), lambda boxes, i: boxes.tag(i)),
+        "score": ("スコア", lambda boxes, i: f"{boxes.scores[i]:.2f}", lambda boxes, i: boxes.scores[i]),
+    }
+    ALL_TAGS = "すべて"
+
+    def __init__(self, parent, tagger, columns, on_edit_text=None):
+        self.tagger = tagger
+        self.columns = columns
+        self.on_edit_text = on_edit_text  # テキスト列を編集可能にする場合のコールバック
+        self.sort_column = None
+        self.sort_reverse = False
+        self.detached = set()  # 絞り込みで非表示にしている行
+        self.edit_entry = None
+
+        self.frame = tk.Frame(parent)
+        self.frame.pack(fill=tk.BOTH, expand=True)
+
+        filter_frame = tk.Frame(self.frame)
+        filter_frame.pack(fill=tk.X)
+        tk.Label(filter_frame, text="タグ:").pack(side=tk.LEFT)
+        self.tag_filter = ttk.Combobox(filter_frame, state="readonly", width=12)
+        self.tag_filter.pack(side=tk.LEFT)
+        self.tag_filter.bind("<<ComboboxSelected>>", lambda e: self.apply_filter())
+        tk.Label(filter_frame, text="最小スコア:").pack(side=tk.LEFT)
+        self.score_filter = tk.Entry(filter_frame, width=6)
+        self.score_filter.pack(side=tk.LEFT)
+        self.score_filter.bind("<Return>", lambda e: self.apply_filter())
+        tk.Button(filter_frame, text="絞り込み", command=self.apply_filter).pack(side=tk.LEFT)
+
+        tree_frame = tk.Frame(self.frame)
+        tree_frame.pack(fill=tk.BOTH, expand=True)
+        self.tree = ttk.Treeview(tree_frame, columns=columns, show="headings")
+        for column in columns:
+            self.tree.heading(column, text=self.COLUMN_FORMATS[column][0], command=lambda c=column: self.sort_by(c))
+            self.tree.column(column, width=120)
+        scrollbar = tk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        if on_edit_text is not None:
+            self.tree.bind("<Double-1>", self.start_edit)
+
+        self.update_tag_choices()
+
+    def update_tag_choices(self):
+        # タグごとの文字色と絞り込みの選択肢
+        for tag, color in self.tagger.tag_colors.items():
+            self.tree.tag_configure(tag, foreground=color)
+        self.tag_filter.configure(values=[self.ALL_TAGS] + list(self.tagger.tag_colors))
+        if not self.tag_filter.get():
+            self.tag_filter.set(self.ALL_TAGS)
+
+    def row_values(self, index):
+        boxes = self.tagger.boxes
+        return [self.COLUMN_FORMATS[column][1](boxes, index) for column in self.columns]
+
+    def reload(self):
+        # ページが変わったときだけ全行を入れ直す
+        self.cancel_edit()
+        self.tree.delete(*self.tree.get_children())
+        self.detached.clear()
+        boxes = self.tagger.boxes
+        for index in range(len(boxes)):
+            self.tree.insert("", tk.END, iid=str(index), values=self.row_values(index), tags=(boxes.tag(index),))
+        self.apply_filter()
+
+    def update_row(self, index):
+        # タグやテキストが変わった行だけを書き換える
+        iid = str(index)
+        if not self.tree.exists(iid):
+            return
+        self.tree.item(iid, values=self.row_values(index), tags=(self.tagger.boxes.tag(index),))
+        visible = index in self.matching_indices([index])
+        if visible and (iid in self.detached or self.sort_column is not None):
+            # 並べ替え中は値の変わった行だけを正しい位置に移す
+            self.detached.discard(iid)
+            self.tree.detach(iid)
+            self.tree.move(iid, "", self.sorted_position(index))
+        elif not visible and iid not in self.detached:
+            self.tree.detach(iid)
+            self.detached.add(iid)
+
+    def matching_indices(self, indices=None):
+        boxes = self.tagger.boxes
+        tag = self.tag_filter.get()
+        if not tag or tag == self.ALL_TAGS:
+            tag = None
+        try:
+            min_score = float(self.score_filter.get())
+        except ValueError:
+            min_score = None  # 未入力や数値以外はスコアで絞り込まない
+        if indices is None:
+            return set(boxes.find(tag=tag, min_score=min_score))
+        return {i for i in indices
+                if (tag is None or boxes.tag(i) == tag) and (min_score is None or boxes.scores[i] >= min_score)}
+
+    def apply_filter(self):
+        # 行を作り直さずにdetach/moveで表示・非表示を切り替える
+        matching = self.matching_indices()
+        for index in range(len(self.tagger.boxes)):
+            iid = str(index)
+            if index in matching:
+                self.detached.discard(iid)
+            elif iid not in self.detached:
+                self.tree.detach(iid)
+                self.detached.add(iid)
+        self.reorder()
+
+    def sort_key(self, index):
+        if self.sort_column is None:
+            return index
+        return self.COLUMN_FORMATS[self.sort_column][2](self.tagger.boxes, index)
+
+    def sort_by(self, column):
+        if self.sort_column == column:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_column = column
+            self.sort_reverse = False
+        self.reorder()
+
+    def visible_indices(self):
+        return [index for index in range(len(self.tagger.boxes)) if str(index) not in self.detached]
+
+    def reorder(self):
+        for position, index in enumerate(sorted(self.visible_indices(), key=self.sort_key, reverse=self.sort_reverse)):
+            self.tree.move(str(index), "", position)
+
+    def sorted_position(self, index):
+        key = self.sort_key(index)
+        position = 0
+        for iid in self.tree.get_children():
+            other = self.sort_key(int(iid))
+            if (other > key) if not self.sort_reverse else (other < key):
+                break
+            position += 1
+        return position
+
+    def start_edit(self, event):
+        iid = self.tree.identify_row(event.y)
+        column = self.tree.identify_column(event.x)
+        if not iid or "text" not in self.columns or column != f"#{self.columns.index('text') + 1}":
+            return
+        self.cancel_edit()
+        bbox = self.tree.bbox(iid, column)
+        if not bbox:
+            return
+        x, y, width, height = bbox
+        index = int(iid)
+        entry = tk.Entry(self.tree)
+        entry.insert(0, self.tagger.boxes.texts[index])
+        entry.select_range(0, tk.END)
+        entry.place(x=x, y=y, width=width, height=height)
+        entry.focus_set()
+
+        def update_text(event):
+            if self.edit_entry is not entry:
+                return
+            new_text = entry.get()
+            self.cancel_edit()
+            self.on_edit_text(index, new_text)
+
+        entry.bind("<Return>", update_text)
+        entry.bind("<FocusOut>", update_text)
+        entry.bind("<Escape>", lambda e: self.cancel_edit())
+        self.edit_entry = entry
+
+    def cancel_edit(self):
+        if self.edit_entry is not None:
+            entry = self.edit_entry
+            self.edit_entry = None
+            entry.destroy()
+
+
+class PageModel:
+    # 表示中のページの状態(矩形・Undo履歴・当たり判定)。Tkに依存しないのでベンチマークなどからも使える
+    def __init__(self):
+        self.image_path = None
+        self.scale = 1.0
+        self.boxes = BoxStore()  # OCRで検出された文字情報
+        self.undo_stack = []
+        self.redo_stack = []
+        self.spatial_index = SpatialGrid()  # boxesの番号で引く当たり判定用インデックス
+
+    def set_boxes(self, boxes, clear_history=False):
+        self.boxes = boxes
+        if clear_history:
+            self.undo_stack.clear()
+            self.redo_stack.clear()
+        self.rebuild_spatial_index()
+
+    def load_ocr_result(self, result):
+        self.set_boxes(BoxStore.from_items(ocr_lines_to_items(result[0])))
+
+    def load_data(self, data):
+        # save_tags形式の辞書を読み込む。画像の読み込みは呼び出し側で行う
+        self.scale = data.get("scale", 1.0)
+        self.image_path = data.get("image_path")
+        self.set_boxes(BoxStore.from_items(data["items"]), clear_history=True)
+
+    def rebuild_spatial_index(self):
+        self.spatial_index = SpatialGrid()
+        for index, box in enumerate(self.boxes.boxes()):
+            self.spatial_index.insert(index, *box)
+
+    def hit_test(self, x, y):
+        # 元画像の座標(x, y)にある矩形の番号。重なっている場合は一番小さい(内側の)矩形を選ぶ
+        indices = self.spatial_index.query_point(x, y)
+        if not indices:
+            return None
+        return min(indices, key=self.boxes.area)
+
+    def query_rect(self, x1, y1, x2, y2):
+        return sorted(self.spatial_index.query_rect(x1, y1, x2, y2))
+
+    def apply_tag(self, indices, tag):
+        # 複数の矩形への変更も1回のUndoで戻せるように1つの操作として積む
+        tag_names = self.boxes.tag_names
+        changes = self.boxes.retag(indices, tag)
+        step = {"tags": [[index, tag_names[old_tag_id], tag] for index, old_tag_id in changes]}
+        self.record_step(step)
+        return step
+
+    def perform(self, step):
+        # まだ適用していない操作を適用して履歴に積む
+        changed = self.apply(step)
+        self.record_step(step)
+        return changed
+
+    def record_step(self, step):
+        self.undo_stack.append(step)
+        self.redo_stack.clear()
+
+    def apply(self, step, reverse=False):
+        changed = apply_step(self.boxes, step, reverse)
+        if "replace" in step:
+            self.rebuild_spatial_index()
+        return changed
+
+    def undo(self):
+        # (操作, 変更した矩形の番号)を返す。戻せる操作がなければNone
+        if not self.undo_stack:
+            return None
+        step = self.undo_stack.pop()
+        self.redo_stack.append(step)
+        return step, self.apply(step, reverse=True)
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        step = self.redo_stack.pop()
+        self.undo_stack.append(step)
+        return step, self.apply(step)
+
+    def save_data(self):
+        return build_save_data(self.image_path, self.scale, self.boxes.items())
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.save_data(), f, ensure_ascii=False, indent=2)
+
+    def snapshot(self):
+        # 作業ログ用。保存形式にUndo/Redoの履歴を加える(書き出しの量が履歴の長さで増えないよう新しい方から一定数だけ)
+        data = self.save_data()
+        data["undo"] = self.undo_stack[-JOURNAL_HISTORY_LIMIT:]
+        data["redo"] = self.redo_stack[-JOURNAL_HISTORY_LIMIT:]
+        return data
+
+    def restore(self, snapshot, entries):
+        # スナップショットを読み込み、その後の操作を順に再生する(画像のパスとスケールは変えない)
+        self.set_boxes(BoxStore.from_items(snapshot["items"]))
+        self.undo_stack = snapshot.get("undo", [])
+        self.redo_stack = snapshot.get("redo", [])
+        for entry in entries:
+            if entry["op"] == "do":
+                self.perform(entry["step"])
+            elif entry["op"] == "undo":
+                self.undo()
+            elif entry["op"] == "redo":
+                self.redo()
+
+
+def _model_attribute(name):
+    return property(lambda self: getattr(self.model, name), lambda self, value: setattr(self.model, name, value))
 
-ocr = PaddleOCR(use_angle_cls=True, lang='japan')  # 日本語対応
 
 class BIFTagger:
     TAGS_FILE = "tags.json"
 
-    def __init__(self, root):
+    # ページの状態はPageModelが持つ(既存のコードからはこれまでどおり属性として使える)
+    image_path = _model_attribute("image_path")
+    scale = _model_attribute("scale")
+    boxes = _model_attribute("boxes")
+    undo_stack = _model_attribute("undo_stack")
+    redo_stack = _model_attribute("redo_stack")
+    spatial_index = _model_attribute("spatial_index")
+
+    def __init__(self, root, prefetch_depth=PREFETCH_DEPTH, prefetch_max_bytes=PREFETCH_MAX_BYTES,
+                 db_path=ANNOTATION_DB, tiled_ocr=None, trace_path=None):
         self.root = root
+        self.trace_path = trace_path  # 終了時に計測結果をJSONLで書き出す
+        self.profiler = None  # cProfileでの記録中はそのインスタンス
+        self.overlay_after = None
+        self.db_path = db_path
+        self.annotation_index = None  # 検索画面を開いたときに接続する
         self.root.title("OCR BIFタグ付けツール")
         self.selected_tag = "O"
-        self.image_path = None
-        self.scale = 1.0  # 画像のスケールを管理
+        self.model = PageModel()
+        self.pyramid = None  # デコード済み画像とズーム用の縮小画像
+        self.tk_image = None
+        self.image_item = None
+        self.zoom_after = None  # ホイールイベントをまとめるためのタイマー
+        self.refine_after = None  # 高品質での描き直し用タイマー
 
         self.tag_colors = {
             "O": "gray",
@@ -26,8 +1920,32 @@ class BIFTagger:
 
         self.load_tags()  # タグ情報を初期化時に読み込む
 
-        self.text_boxes = []  # OCRで検出された文字情報
-        self.undo_stack = []
+        self.journal = None  # 表示中の画像の作業ログ
+        self.items_scale = None  # キャンバス上の矩形が配置されているスケール
+        self.labels_visible = False
+        self.drag_start = None
+        self.drag_rect_id = None
+
+        # OCRはワーカースレッドで実行し、結果はキュー経由でTkのメインループに渡す
+        self.executor = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+        self.io_executor = ThreadPoolExecutor(max_workers=1)  # 索引の取り込みなどOCR以外の重い処理用
+        self.pretagger_future = self.io_executor.submit(self.load_pretagger)  # 大きな辞書の読み込みは裏で行う
+        self.pretag_enabled = tk.BooleanVar(value=True)
+        self.region_ocr_mode = tk.BooleanVar(value=False)  # ドラッグした範囲をタグ付けではなく再OCRする
+        self.region_ocr_future = None
+        self.ui_queue = queue.Queue()
+        self.ocr_job_id = 0  # 古いOCR結果を破棄するための世代番号
+        self.ocr_future = None
+        self.tiled_ocr = tiled_ocr if tiled_ocr is not None else TiledOCR(ocr)
+        self.tiled_ocr_enabled = tk.BooleanVar(value=True)
+        self.use_tiled_ocr = True  # ワーカースレッドから参照する値(Tkの変数はメインスレッドでだけ読む)
+        self.tag_source = None  # OCR後にタグを引き継ぐ類似ページ(項目, 画像の大きさ)
+
+        # 作業フォルダモード(フォルダ内の画像を順に開き、次の数枚を先読みする)
+        self.work_files = []
+        self.work_index = -1
+        self.prefetch = PrefetchPipeline(self.executor, prefetch_depth, prefetch_max_bytes, ocr_func=self.ocr_page,
+                                         watch=self.watch_future)
 
         # 画像表示エリア用のフレームを作成
         self.image_frame = tk.Frame(root)
@@ -36,15 +1954,21 @@ class BIFTagger:
         self.canvas = tk.Canvas(self.image_frame, width=800, height=600, bg='white', scrollregion=(0, 0, 1000, 1000))
         self.canvas.grid(row=0, column=0, sticky="nsew")
 
-        self.scroll_x = tk.Scrollbar(self.image_frame, orient=tk.HORIZONTAL, command=self.canvas.xview)
+        self.scroll_x = tk.Scrollbar(self.image_frame, orient=tk.HORIZONTAL, command=self.scroll_canvas_x)
         self.scroll_x.grid(row=1, column=0, sticky="ew")
-        self.scroll_y = tk.Scrollbar(self.image_frame, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.scroll_y = tk.Scrollbar(self.image_frame, orient=tk.VERTICAL, command=self.scroll_canvas_y)
         self.scroll_y.grid(row=0, column=1, sticky="ns")
 
         self.image_frame.grid_rowconfigure(0, weight=1)
         self.image_frame.grid_columnconfigure(0, weight=1)
 
         self.canvas.configure(xscrollcommand=self.scroll_x.set, yscrollcommand=self.scroll_y.set)
+        self.tile_renderer = TileRenderer(self.canvas)
+        # 計測値のオーバーレイ(キャンバスの右上に重ねて表示する)
+        self.overlay_label = tk.Label(self.image_frame, justify=tk.LEFT, anchor=tk.NW, font=("Courier", 9),
+                                      bg="#ffffe0", relief=tk.SOLID, borderwidth=1)
+        self.tiled = False  # 大きな画像をタイル描画しているか
+        self.tile_after = None
 
         self.btn_frame = tk.Frame(root)
         self.btn_frame.pack()
@@ -54,13 +1978,40 @@ class BIFTagger:
         tk.Button(self.btn_frame, text="保存", command=self.save_tags).pack(side=tk.LEFT)
         tk.Button(self.btn_frame, text="読み込み", command=self.load_saved_data).pack(side=tk.LEFT)
         tk.Button(self.btn_frame, text="Undo", command=self.undo).pack(side=tk.LEFT)
+        tk.Button(self.btn_frame, text="Redo", command=self.redo).pack(side=tk.LEFT)
         tk.Button(self.btn_frame, text="タグ編集", command=self.edit_tags).pack(side=tk.LEFT)
         tk.Button(self.btn_frame, text="フィット表示", command=self.fit_to_canvas).pack(side=tk.LEFT)
         tk.Button(self.btn_frame, text="タグ情報表示", command=self.show_tag_table).pack(side=tk.LEFT)
+        tk.Button(self.btn_frame, text="フォルダを開く", command=self.open_work_folder).pack(side=tk.LEFT)
+        tk.Button(self.btn_frame, text="検索", command=self.show_search).pack(side=tk.LEFT)
+        tk.Checkbutton(self.btn_frame, text="自動タグ付け", variable=self.pretag_enabled).pack(side=tk.LEFT)
+        tk.Checkbutton(self.btn_frame, text="領域再OCR", variable=self.region_ocr_mode).pack(side=tk.LEFT)
+        tk.Checkbutton(self.btn_frame, text="大判分割OCR", variable=self.tiled_ocr_enabled,
+                       command=lambda: setattr(self, "use_tiled_ocr", self.tiled_ocr_enabled.get())).pack(side=tk.LEFT)
+        self.overlay_enabled = tk.BooleanVar(value=False)
+        self.profile_enabled = tk.BooleanVar(value=False)
+        perf_button = tk.Menubutton(self.btn_frame, text="計測", relief=tk.RAISED)
+        perf_menu = tk.Menu(perf_button, tearoff=False)
+        perf_menu.add_checkbutton(label="計測値を表示", variable=self.overlay_enabled, command=self.toggle_overlay)
+        perf_menu.add_command(label="トレースを保存...", command=self.export_trace)
+        perf_menu.add_checkbutton(label="cProfileで記録", variable=self.profile_enabled, command=self.toggle_profile)
+        perf_button.config(menu=perf_menu)
+        perf_button.pack(side=tk.LEFT)
+        tk.Button(self.btn_frame, text="← 前へ", command=self.prev_page).pack(side=tk.LEFT)
+        tk.Button(self.btn_frame, text="次へ →", command=self.next_page).pack(side=tk.LEFT)
+        self.work_label = tk.Label(self.btn_frame, text="")
+        self.work_label.pack(side=tk.LEFT)
 
         self.selected_tag_label = tk.Label(self.btn_frame, text=f"選択中のタグ: {self.selected_tag}", fg="black")
         self.selected_tag_label.pack(side=tk.LEFT)
 
+        self.ocr_status_label = tk.Label(self.btn_frame, text="OCR: 未初期化", fg="gray")
+        self.ocr_status_label.pack(side=tk.LEFT)
+
+        # OCR実行中の進捗表示とキャンセルボタン(実行中のみ表示)
+        self.ocr_progress = ttk.Progressbar(self.btn_frame, mode="indeterminate", length=100)
+        self.ocr_cancel_button = tk.Button(self.btn_frame, text="キャンセル", command=self.cancel_ocr)
+
         # タグ選択ボタン
         self.tag_button_frame = tk.Frame(root)
         self.tag_button_frame.pack()
@@ -69,25 +2020,126 @@ class BIFTagger:
         self.table_frame = tk.Frame(root)
         self.table_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)  # エリアのサイズを大きくするためにパディングを追加
 
-        self.table_canvas = tk.Canvas(self.table_frame)
-        self.table_scrollbar = tk.Scrollbar(self.table_frame, orient=tk.VERTICAL, command=self.table_canvas.yview)
-        self.table_inner_frame = tk.Frame(self.table_canvas)
-
-        self.table_inner_frame.bind(
-            "<Configure>",
-            lambda e: self.table_canvas.configure(scrollregion=self.table_canvas.bbox("all"))
-        )
-
-        self.table_canvas.create_window((0, 0), window=self.table_inner_frame, anchor="nw")
-        self.table_canvas.configure(yscrollcommand=self.table_scrollbar.set)
-
-        self.table_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.table_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        # タグ一覧(別ウィンドウの一覧もここに登録して同じデータを差分更新する)
+        self.tag_table = TagTable(self.table_frame, self, ("pos", "text", "tag", "score"), on_edit_text=self.update_text)
+        self.tag_tables = [self.tag_table]
 
         self.update_tag_table()  # 初期状態で表を更新
 
-        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<ButtonPress-1>", self.on_press)
+        self.canvas.bind("<B1-Motion>", self.on_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_release)
         self.canvas.bind("<MouseWheel>", self.zoom_image)  # マウスホイールイベントをバインド
+        self.canvas.bind("<Configure>", lambda e: self.schedule_tile_update())
+        self.root.bind("<Control-Right>", lambda e: self.next_page())
+        self.root.bind("<Control-z>", lambda e: self.undo())
+        self.root.bind("<Control-y>", lambda e: self.redo())
+        self.root.bind("<Control-Left>", lambda e: self.prev_page())
+
+        # ウィンドウ表示後にOCRエンジンをバックグラウンドで準備する
+        self.root.after_idle(self.start_ocr_warmup)
+        self.root.after(50, self.process_ui_queue)
+        self.root.after(JOURNAL_FLUSH_MS, self.flush_journal)
+
+    def run_in_background(self, func, *args, callback=None):
+        future = self.executor.submit(func, *args)
+        if callback is not None:
+            self.watch_future(future, callback)
+        return future
+
+    def watch_future(self, future, callback):
+        # 完了通知はワーカースレッドから呼ばれるので、Tkの操作はメインループ側で行う
+        future.add_done_callback(lambda f: self.ui_queue.put((callback, f)))
+
+    def process_ui_queue(self):
+        try:
+            while True:
+                try:
+                    callback, future = self.ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                # 1件の失敗でキューの処理全体が止まらないよう、個別に捕捉して報告する
+                try:
+                    callback(future)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            self.root.after(50, self.process_ui_queue)
+
+    def close(self):
+        if self.profiler is not None:
+            self.profile_enabled.set(False)
+            self.toggle_profile()
+        if self.trace_path:
+            print(f"計測結果 {perf.export(self.trace_path)}件を {self.trace_path} に保存しました")
+        self.close_journal()
+        self.save_tags_to_file()
+        self.prefetch.shutdown()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.io_executor.shutdown(wait=False, cancel_futures=True)
+        self.tiled_ocr.close()
+        if self.annotation_index is not None:
+            self.annotation_index.close()
+        self.root.destroy()
+
+    def toggle_overlay(self):
+        if self.overlay_enabled.get():
+            self.overlay_label.place(relx=1.0, x=-20, y=4, anchor=tk.NE)
+            self.refresh_overlay()
+        else:
+            if self.overlay_after is not None:
+                self.root.after_cancel(self.overlay_after)
+                self.overlay_after = None
+            self.overlay_label.place_forget()
+
+    def refresh_overlay(self):
+        lines = [f"{'':<18}{'last':>8}{'avg':>8}{'n':>6}"]
+        for name, count, last, avg, _ in perf.summary()[:12]:
+            lines.append(f"{name[:18]:<18}{last:>8.1f}{avg:>8.1f}{count:>6}")
+        lines.append(f"boxes {len(self.boxes)}  canvas items {len(self.canvas.find_all())}")
+        if ocr.cache is not None:
+            stats = ocr.cache.stats()
+            lines.append(f"OCR cache hit {stats['hits']} / miss {stats['misses']}")
+        if self.pyramid is not None:
+            lines.append(f"zoom cache {self.pyramid.nbytes() / (1024 * 1024):.0f}MB")
+        self.overlay_label.config(text="\n".join(lines))
+        self.overlay_after = self.root.after(PERF_OVERLAY_MS, self.refresh_overlay)
+
+    def export_trace(self):
+        path = filedialog.asksaveasfilename(defaultextension=".jsonl", filetypes=[("JSONL", "*.jsonl")])
+        if path:
+            count = perf.export(path)
+            messagebox.showinfo("保存完了", f"{count}件の計測結果を {path} に保存しました。")
+
+    def toggle_profile(self):
+        # cProfileはメインスレッド(UIの処理)だけを記録する。OCRなどワーカーの処理は計測値で見る
+        if self.profile_enabled.get():
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        path = time.strftime("profile_%Y%m%d_%H%M%S.prof")
+        self.profiler.dump_stats(path)
+        pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(25)
+        self.profiler = None
+        print(f"プロファイルを {path} に保存しました (python -m pstats {path} で確認できます)")
+
+    def start_ocr_warmup(self):
+        print(f"UI起動時間: {time.perf_counter() - APP_START_TIME:.2f}秒")
+        if not ocr.is_ready():
+            ocr.warmup()
+        self.update_ocr_status()
+
+    def update_ocr_status(self):
+        if ocr.error is not None:
+            self.ocr_status_label.config(text="OCR: 初期化失敗", fg="red")
+        elif ocr.is_ready():
+            self.ocr_status_label.config(text=f"OCR: 準備完了 ({ocr.startup_time:.1f}秒)", fg="green")
+        else:
+            self.ocr_status_label.config(text="OCR: 初期化中...", fg="orange")
+            self.root.after(200, self.update_ocr_status)  # 準備できるまでポーリング
 
     def update_tag_buttons(self):
         for widget in self.tag_button_frame.winfo_children():
@@ -105,197 +2157,581 @@ class BIFTagger:
         path = filedialog.askopenfilename(filetypes=[("Image Files", "*.png *.jpg *.jpeg")])
         if not path:
             return
+        self.scale = 1.0  # 画像を読み込むたびにスケールをリセット
+        self.open_page(path)
+
+    def open_page(self, path, pyramid=None, ocr_future=None):
+        self.close_journal()
+        self.set_image(path, pyramid)
+        self.tag_source = None
+
+        self.model.set_boxes(BoxStore(), clear_history=True)
+        self.update_tag_table()
+
+        # 前回の作業ログが残っていればOCRせずに復元できる
+        journal = AnnotationJournal(path)
+        if journal.exists():
+            if journal.has_unsaved_work() and messagebox.askyesno("作業の復元", "この画像の作業内容(自動保存)が残っています。復元しますか?"):
+                self.cancel_ocr()
+                if ocr_future is not None:
+                    ocr_future.cancel()
+                self.restore_journal(journal)
+                return
+            journal.discard()
+
+        # 保存済みのページとほぼ同じなら、OCRを省略するかタグを引き継ぐ
+        match = self.find_similar_page()
+        if match is not None:
+            distance, json_path, _, width, height = match
+            answer = messagebox.askyesnocancel(
+                "類似ページ",
+                f"保存済みの {os.path.basename(json_path)} とほぼ同じページです(距離 {distance})。\n"
+                "はい: 保存済みの矩形とタグをそのまま使う(OCRしない)\n"
+                "いいえ: OCRしてからタグを引き継ぐ\n"
+                "キャンセル: 引き継がない")
+            if answer is not None:
+                try:
+                    with open(json_path, "r", encoding="utf-8") as f:
+                        saved_items = json.load(f)["items"]
+                except (OSError, ValueError, KeyError) as e:
+                    messagebox.showwarning("類似ページ", f"{json_path} を読み込めませんでした: {e}")
+                else:
+                    if answer:
+                        self.cancel_ocr()
+                        if ocr_future is not None:
+                            ocr_future.cancel()
+                        self.apply_similar_page(saved_items, (width, height))
+                        return
+                    self.tag_source = (saved_items, (width, height))
+
+        # OCR実行(UIを止めないようにワーカースレッドで実行)
+        self.start_ocr(path, ocr_future)
+
+    def get_annotation_index(self):
+        if self.annotation_index is None:
+            self.annotation_index = AnnotationIndex(self.db_path)
+        return self.annotation_index
+
+    def find_similar_page(self):
+        # ピラミッドの一番小さい画像からハッシュを計算するので、ページを開く時間はほとんど変わらない
+        # 照合できなくてもページは開けるように、失敗は表示だけして続ける
+        if self.annotation_index is None and not os.path.exists(self.db_path):
+            return None
+        start = time.perf_counter()
+        try:
+            value = page_hash(self.pyramid.levels[-1])
+            matches = self.get_annotation_index().similar_pages(value)
+        except (sqlite3.Error, OSError) as e:
+            print("類似ページを検索できませんでした:", e)
+            return None
+        print(f"類似ページ検索: {len(matches)}件 ({(time.perf_counter() - start) * 1000:.1f}ms)")
+        return matches[0] if matches else None
+
+    def apply_similar_page(self, saved_items, saved_size):
+        size = (self.pyramid.width, self.pyramid.height)
+        items = transform_items(saved_items, estimate_page_transform(saved_items, None, saved_size, size))
+        self.model.set_boxes(BoxStore.from_items(items))
+        self.start_journal()
+        self.create_box_items()
+        self.update_tag_table()
+        self.ocr_status_label.config(text="OCR: 類似ページから流用", fg="green")
+
+    def open_work_folder(self):
+        folder = filedialog.askdirectory()
+        if not folder:
+            return
+        self.set_work_files(list(iter_image_files(folder)))
+
+    def set_work_files(self, paths):
+        self.prefetch.clear()
+        self.work_files = paths
+        self.work_index = -1
+        if not paths:
+            messagebox.showwarning("画像がありません", "フォルダに画像ファイルが見つかりませんでした。")
+            self.work_label.config(text="")
+            return
+        self.go_to_page(0)
+
+    def next_page(self):
+        if self.work_index + 1 < len(self.work_files):
+            self.go_to_page(self.work_index + 1)
+
+    def prev_page(self):
+        if self.work_index > 0:
+            self.go_to_page(self.work_index - 1)
+
+    def go_to_page(self, index):
+        self.work_index = index
+        path = self.work_files[index]
+        self.work_label.config(text=f"{index + 1}/{len(self.work_files)} {os.path.basename(path)}")
+        canvas_size = (self.canvas.winfo_width(), self.canvas.winfo_height())
+
+        # 先読み済みならデコードもOCRも待たずに表示できる
+        pyramid = None
+        ocr_future = None
+        prefetched = self.prefetch.take(path)
+        if prefetched is not None:
+            image_future, ocr_future = prefetched
+            # まだ始まっていないデコードは取り消して下でデコードし、実行中のものは終わるのを待つ
+            # (メモリの上限のために画像を捨てたページはNone)
+            if image_future is not None and not image_future.cancel() and image_future.exception() is None:
+                pyramid = image_future.result()
+            if ocr_future.cancelled():
+                ocr_future = None
+        if pyramid is None:
+            pyramid = PrefetchPipeline.decode(path, None)
+        self.scale = fit_scale(pyramid.width, pyramid.height, *canvas_size)
+        self.canvas.xview_moveto(0)
+        self.canvas.yview_moveto(0)
+        self.open_page(path, pyramid, ocr_future)
+
+        self.prefetch.prefetch(self.work_files[index + 1:], canvas_size)
+
+    def set_image(self, path, pyramid=None):
+        # 画像のデコードは1回だけ行い、ズーム用のピラミッドを作っておく
+        self.cancel_zoom_render()
         self.image_path = path
-        image = Image.open(path)
-        self.tk_image = ImageTk.PhotoImage(image)
+        self.pyramid = pyramid if pyramid is not None else ImagePyramid(Image.open(path))
+        self.tile_renderer.clear()
         self.canvas.delete("all")
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-
-        self.scale = 1.0  # 画像を読み込むたびにスケールをリセット
+        self.image_item = None
+        self.items_scale = None
+        self.render_image()
+
+    def clear_image(self):
+        self.cancel_zoom_render()
+        self.pyramid = None
+        self.tk_image = None
+        self.tile_renderer.clear()
+        self.canvas.delete("all")
+        self.image_item = None
+        self.items_scale = None
 
-        # OCR実行
-        result = ocr.ocr(path, cls=True)
-        self.text_boxes.clear()
-
-        for line in result[0]:
-            box, (text, score) = line  # スコアも取得
-            x1 = min(point[0] for point in box)  # x座標の最小値
-            y1 = min(point[1] for point in box)  # y座標の最小値
-            x2 = max(point[0] for point in box)  # x座標の最大値
-            y2 = max(point[1] for point in box)  # y座標の最大値
-            tag = "O"
-            color = self.tag_colors.get(tag, "gray")
-            rect_id = self.canvas.create_rectangle(x1, y1, x2, y2, outline=color, width=2, tags="box")
-            text_id = self.canvas.create_text(x1, y1 - 3, text=text, anchor=tk.SW, fill=color, font=("Arial", 10, "bold"))
-            tag_id = self.canvas.create_text(x2, y2 + 3, text=tag, anchor=tk.NE, fill=color, font=("Arial", 10, "bold"))
-            self.text_boxes.append({
-                "text": text,
-                "box": [[x1, y1], [x2, y2]],
-                "tag": tag,
-                "score": score,  # スコアを保存
-                "rect_id": rect_id,
-                "text_id": text_id,
-                "tag_id": tag_id
-            })
-
-        # OCRで検出された矩形を再描画
-        for item in self.text_boxes:
-            box = item["box"]
-            x, y = box[0]  # 左上の座標
-            x2, y2 = box[1]  # 右下の座標
-            width = x2 - x
-            height = y2 - y
-            scaled_box = [
-                x * self.scale,
-                y * self.scale,
-                width * self.scale,
-                height * self.scale
-            ]
-            color = self.tag_colors.get(item["tag"], "gray")
-            rect_id = self.canvas.create_rectangle(
-                scaled_box[0], scaled_box[1],
-                scaled_box[0] + scaled_box[2], scaled_box[1] + scaled_box[3],
-                outline=color, width=2, tags="box"
-            )
-            text_id = self.canvas.create_text(
-                scaled_box[0], scaled_box[1] - 3,
-                text=item["text"], anchor=tk.SW, fill=color, font=("Arial", 10, "bold")
-            )
-            tag_id = self.canvas.create_text(
-                scaled_box[0] + scaled_box[2], scaled_box[1] + scaled_box[3] + 3,
-                text=item["tag"], anchor=tk.NE, fill=color, font=("Arial", 10, "bold")
-            )
-            item.update({"rect_id": rect_id, "text_id": text_id, "tag_id": tag_id})
+    @perf.timed("render_image")
+    def render_image(self, preview=False):
+        if self.pyramid is None:
+            return
+        width, height = self.pyramid.scaled_size(self.scale)
+        self.tiled = width * height > TILED_RENDER_THRESHOLD
+        if self.tiled:
+            # 拡大後の画像が大きいときは表示範囲のタイルだけを描画する
+            if self.image_item is not None:
+                self.canvas.delete(self.image_item)
+                self.image_item = None
+                self.tk_image = None
+            self.canvas.configure(scrollregion=(0, 0, width, height))
+            self.tile_renderer.update(self.pyramid, self.scale, preview)
+            return
+        self.tile_renderer.clear()
+        resized_image = self.pyramid.render(self.scale, preview=preview)
+        self.tk_image = ImageTk.PhotoImage(resized_image)
+        if self.image_item is None:
+            self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image, tags="image")
+            self.canvas.tag_lower("image")
+        else:
+            self.canvas.itemconfig(self.image_item, image=self.tk_image)
+        self.canvas.configure(scrollregion=(0, 0, resized_image.width, resized_image.height))
+
+    def scroll_canvas_x(self, *args):
+        self.canvas.xview(*args)
+        self.schedule_tile_update()
+
+    def scroll_canvas_y(self, *args):
+        self.canvas.yview(*args)
+        self.schedule_tile_update()
+
+    def schedule_tile_update(self):
+        # スクロールイベントが続いてもタイルの読み込みはアイドル時に1回だけ行う
+        if self.tiled and self.tile_after is None:
+            self.tile_after = self.root.after_idle(self.update_tiles)
+
+    @perf.timed("update_tiles")
+    def update_tiles(self):
+        self.tile_after = None
+        if self.tiled and self.pyramid is not None:
+            self.tile_renderer.update(self.pyramid, self.scale)
+
+    def create_box_items(self):
+        # ページのデータが変わったときだけ矩形を作り直す。ズーム時はlayout_boxesで位置だけ更新する
+        with perf.span("create_box_items", boxes=len(self.boxes)) as span:
+            self.canvas.delete("box", "label")
+            boxes = self.boxes
+            scale = self.scale
+            for index in range(len(boxes)):
+                color = self.tag_colors.get(boxes.tag(index), "gray")
+                boxes.rect_ids[index] = self.canvas.create_rectangle(
+                    boxes.x1[index] * scale, boxes.y1[index] * scale,
+                    boxes.x2[index] * scale, boxes.y2[index] * scale,
+                    outline=color, width=2, tags="box"
+                )
+                boxes.text_ids[index] = 0
+                boxes.tag_item_ids[index] = 0
+            self.items_scale = self.scale
+            self.labels_visible = False
+            self.update_label_visibility()
+            span["canvas_items"] = len(self.canvas.find_all())
+
+    def create_labels(self, index):
+        boxes = self.boxes
+        tag = boxes.tag(index)
+        color = self.tag_colors.get(tag, "gray")
+        boxes.text_ids[index] = self.canvas.create_text(
+            boxes.x1[index] * self.items_scale, boxes.y1[index] * self.items_scale - 3,
+            text=boxes.texts[index], anchor=tk.SW, fill=color, font=("Arial", 10, "bold"), tags=("label", "label_text")
+        )
+        boxes.tag_item_ids[index] = self.canvas.create_text(
+            boxes.x2[index] * self.items_scale, boxes.y2[index] * self.items_scale + 3,
+            text=tag, anchor=tk.NE, fill=color, font=("Arial", 10, "bold"), tags=("label", "label_tag")
+        )
 
+    @perf.timed("layout_boxes")
+    def layout_boxes(self):
+        if self.items_scale is None:
+            self.create_box_items()
+            return
+        factor = self.scale / self.items_scale
+        if factor != 1.0:
+            # 既存のアイテムを原点基準で拡大縮小する。ラベルの3pxのずれは拡大されないように戻す
+            self.canvas.scale("box", 0, 0, factor, factor)
+            self.canvas.scale("label", 0, 0, factor, factor)
+            self.canvas.move("label_text", 0, 3 * factor - 3)
+            self.canvas.move("label_tag", 0, 3 - 3 * factor)
+            self.items_scale = self.scale
+        self.update_label_visibility()
+
+    def update_label_visibility(self):
+        # 縮小表示ではラベルを隠す。まだ作っていないラベルは表示が必要になったときに作る
+        visible = self.scale >= LABEL_MIN_SCALE
+        if visible:
+            text_ids = self.boxes.text_ids
+            for index in range(len(self.boxes)):
+                if not text_ids[index]:
+                    self.create_labels(index)
+        if visible != self.labels_visible:
+            self.canvas.itemconfigure("label", state=tk.NORMAL if visible else tk.HIDDEN)
+            self.labels_visible = visible
+
+    def update_box_style(self, index):
+        # タグが変わった矩形だけ色とラベルを更新する
+        boxes = self.boxes
+        tag = boxes.tag(index)
+        color = self.tag_colors.get(tag, "red")
+        self.canvas.itemconfig(boxes.rect_ids[index], outline=color)
+        if boxes.tag_item_ids[index]:
+            self.canvas.itemconfig(boxes.tag_item_ids[index], text=tag, fill=color)
+            self.canvas.itemconfig(boxes.text_ids[index], fill=color)
+
+    def start_ocr(self, path, future=None):
+        # futureを渡した場合は先読みで投入済みのOCRの完了を待つ
+        self.cancel_ocr()
+        job_id = self.ocr_job_id
+        callback = lambda future: self.on_ocr_done(job_id, path, future)
+        if future is None:
+            self.ocr_future = self.run_in_background(self.ocr_page, path, True, callback=callback)
+        else:
+            self.ocr_future = future
+            self.watch_future(future, callback)
+        self.ocr_progress.pack(side=tk.LEFT)
+        self.ocr_progress.start(10)
+        self.ocr_cancel_button.pack(side=tk.LEFT)
+        self.ocr_status_label.config(text="OCR: 実行中...", fg="orange")
+
+    def ocr_page(self, path, cls=True):
+        # ワーカースレッドで呼ばれる。大きなページは分割して複数プロセスでOCRする
+        if self.use_tiled_ocr and self.tiled_ocr.needs_tiling(path):
+            return self.tiled_ocr.ocr(path, cls)
+        return ocr.ocr(path, cls)
+
+    def cancel_ocr(self):
+        self.ocr_job_id += 1  # 実行中の結果が後から届いても無視されるようにする
+        if self.ocr_future is not None:
+            self.ocr_future.cancel()
+            self.ocr_future = None
+            self.ocr_status_label.config(text="OCR: キャンセル", fg="gray")
+        self.ocr_progress.stop()
+        self.ocr_progress.pack_forget()
+        self.ocr_cancel_button.pack_forget()
+
+    def on_ocr_done(self, job_id, path, future):
+        if job_id != self.ocr_job_id or path != self.image_path:
+            return  # 別の画像を開いた後に届いた古い結果は破棄
+        self.ocr_future = None
+        self.ocr_progress.stop()
+        self.ocr_progress.pack_forget()
+        self.ocr_cancel_button.pack_forget()
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            self.ocr_status_label.config(text="OCR: エラー", fg="red")
+            messagebox.showerror("OCRエラー", str(e))
+            return
+        if ocr.cache is not None:
+            stats = ocr.cache.stats()
+            print(f"OCRキャッシュ: ヒット {stats['hits']} / ミス {stats['misses']} (ヒット率 {stats['hit_rate']:.0%})")
+            self.ocr_status_label.config(text=f"OCR: 完了 (キャッシュ ヒット{stats['hits']}/ミス{stats['misses']})", fg="green")
+        else:
+            self.ocr_status_label.config(text="OCR: 完了", fg="green")
+        self.apply_ocr_result(result)
+
+    @perf.timed("apply_ocr_result")
+    def apply_ocr_result(self, result):
+        self.model.load_ocr_result(result)
+        if self.tag_source is not None:
+            self.transfer_similar_tags()
+        if self.pretag_enabled.get():
+            self.pretag()
+        self.start_journal()  # 自動で付けたタグまでは未保存の作業として扱わない
+
+        # OCRで検出された矩形を描画(結果待ちの間にズームされている場合もあるのでスケールを反映)
+        self.create_box_items()
         self.update_tag_table()  # 画像を開いた後に表を更新
 
+    def transfer_similar_tags(self):
+        saved_items, saved_size = self.tag_source
+        self.tag_source = None
+        size = (self.pyramid.width, self.pyramid.height)
+        transform = estimate_page_transform(saved_items, list(self.boxes.items()), saved_size, size)
+        changes = transfer_tags(self.boxes, transform_items(saved_items, transform))
+        print(f"類似ページからタグを引き継ぎ: {len(changes)}件")
+        if changes:
+            self.record_step({"tags": changes})
+
+    def load_pretagger(self):
+        pretagger = PreTagger.load()
+        print(pretagger.summary())
+        return pretagger
+
+    def pretag(self):
+        try:
+            pretagger = self.pretagger_future.result()
+        except Exception as e:
+            print("自動タグ付けのルールを読み込めませんでした:", e)
+            return
+        start = time.perf_counter()
+        changes = pretagger.apply(self.boxes)
+        elapsed = time.perf_counter() - start
+        perf.record("pretag", elapsed, start, boxes=len(self.boxes), tagged=len(changes))
+        print(f"自動タグ付け: {len(self.boxes)}件中{len(changes)}件 ({elapsed * 1000:.1f}ms)")
+        if changes:
+            self.record_step({"tags": changes})  # 自動で付けたタグは1回のUndoでまとめて戻せる
+
+    def on_press(self, event):
+        self.drag_start = (self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
+    def on_drag(self, event):
+        if self.drag_start is None:
+            return
+        x0, y0 = self.drag_start
+        x = self.canvas.canvasx(event.x)
+        y = self.canvas.canvasy(event.y)
+        if self.drag_rect_id is None:
+            if abs(x - x0) < DRAG_THRESHOLD and abs(y - y0) < DRAG_THRESHOLD:
+                return
+            self.drag_rect_id = self.canvas.create_rectangle(x0, y0, x, y, outline="red", dash=(4, 2), tags="selection")
+        else:
+            self.canvas.coords(self.drag_rect_id, x0, y0, x, y)
+
+    @perf.timed("tag.drag")
+    def on_release(self, event):
+        if self.drag_rect_id is None:
+            self.drag_start = None
+            self.on_click(event)
+            return
+        # ドラッグした範囲に重なる矩形すべてに選択中のタグを付ける
+        x0, y0, x1, y1 = self.canvas.coords(self.drag_rect_id)
+        self.canvas.delete(self.drag_rect_id)
+        self.drag_rect_id = None
+        self.drag_start = None
+        region = (min(x0, x1) / self.scale, min(y0, y1) / self.scale,
+                  max(x0, x1) / self.scale, max(y0, y1) / self.scale)
+        if self.region_ocr_mode.get():
+            self.start_region_ocr(region)
+            return
+        indices = self.model.query_rect(*region)
+        if indices:
+            self.apply_tag(indices, self.selected_tag)
+            print(f"{len(indices)}件の矩形にタグ '{self.selected_tag}' を付与")
+
+    @perf.timed("tag.click")
     def on_click(self, event):
         # スクロールオフセットを考慮してクリック位置を計算
         x = (self.canvas.canvasx(event.x)) / self.scale
         y = (self.canvas.canvasy(event.y)) / self.scale
-        for item in self.text_boxes:
-            box = item["box"]
-            x1, y1 = box[0]  # 左上の座標
-            x2, y2 = box[1]  # 右下の座標
-
-            if x1 <= x <= x2 and y1 <= y <= y2:  # クリック位置が矩形内にあるか確認
-                item["tag"] = self.selected_tag
-                color = self.tag_colors.get(self.selected_tag, "red")
-                self.canvas.itemconfig(item["rect_id"], outline=color)
-                self.canvas.itemconfig(item["tag_id"], text=self.selected_tag, fill=color)
-                self.canvas.itemconfig(item["text_id"], fill=color)
-                self.undo_stack.append(item.copy())
-                self.update_tag_table()  # タグ変更後に表を更新
-                print(f"{item['text']} にタグ '{self.selected_tag}' を付与")
-                break
+        index = self.model.hit_test(x, y)
+        if index is None:
+            return
+        self.apply_tag([index], self.selected_tag)
+        print(f"{self.boxes.texts[index]} にタグ '{self.selected_tag}' を付与")
 
+    def start_region_ocr(self, region):
+        if self.pyramid is None:
+            return
+        if self.region_ocr_future is not None and not self.region_ocr_future.done():
+            return  # 前の領域のOCRが終わるまで受け付けない
+        boxes = self.boxes
+        path = self.image_path
+        start = time.perf_counter()
+        self.region_ocr_future = self.run_in_background(
+            region_ocr_items, ocr, self.pyramid.levels[0], region,
+            callback=lambda future: self.on_region_ocr_done(path, boxes, region, start, future))
+        self.ocr_status_label.config(text="OCR: 領域を実行中...", fg="orange")
+
+    def on_region_ocr_done(self, path, boxes, region, start, future):
+        self.region_ocr_future = None
+        if path != self.image_path or boxes is not self.boxes:
+            return  # 別の画像を開いたか、ページ全体のOCR結果で置き換わった
+        try:
+            new_items = future.result()
+        except Exception as e:
+            self.ocr_status_label.config(text="OCR: エラー", fg="red")
+            messagebox.showerror("OCRエラー", str(e))
+            return
+        if self.pretag_enabled.get() and self.pretagger_future.done() and self.pretagger_future.exception() is None:
+            self.pretagger_future.result().apply_items(new_items)
+        old_items = list(self.boxes.items())
+        removed = region_replaced_indices(old_items, region, new_items)
+        step = {"replace": [[[index, old_items[index]] for index in removed], new_items]}
+        self.model.perform(step)
+        self.write_journal({"op": "do", "step": step})
+        self.create_box_items()
+        self.update_tag_table()
+        elapsed = time.perf_counter() - start
+        print(f"領域再OCR: {len(removed)}件を{len(new_items)}件に置き換え ({elapsed:.2f}秒)")
+        self.ocr_status_label.config(text=f"OCR: 領域完了 ({elapsed:.2f}秒)", fg="green")
+
+    def apply_tag(self, indices, tag):
+        step = self.model.apply_tag(indices, tag)
+        self.write_journal({"op": "do", "step": step})
+        self.refresh_boxes(indices)
+
+    def record_step(self, step):
+        # 適用済みの変更を履歴と作業ログに積む
+        self.model.record_step(step)
+        self.write_journal({"op": "do", "step": step})
+
+    def refresh_boxes(self, indices):
+        for index in indices:
+            self.update_box_style(index)
+            if self.boxes.text_ids[index]:
+                self.canvas.itemconfig(self.boxes.text_ids[index], text=self.boxes.texts[index])
+        self.update_tag_rows(indices)  # 変更した行だけ表を更新
+
+    @perf.timed("undo")
     def undo(self):
-        if not self.undo_stack:
+        result = self.model.undo()  # 変更前の状態に戻す
+        if result is None:
             return
-        last = self.undo_stack.pop()
-        for item in self.text_boxes:
-            if item["rect_id"] == last["rect_id"]:
-                item["tag"] = "O"
-                self.canvas.itemconfig(item["rect_id"], outline=self.tag_colors["O"])
-                if "text_id" in item:
-                    self.canvas.delete(item["text_id"])
-                item["text_id"] = self.canvas.create_text(
-                    item["box"][2][0], item["box"][2][1],
-                    text="O", anchor=tk.SE, fill=self.tag_colors["O"], font=("Arial", 10, "bold"))
-                break
+        self.write_journal({"op": "undo"})
+        self.show_history(*result)
+
+    @perf.timed("redo")
+    def redo(self):
+        result = self.model.redo()
+        if result is None:
+            return
+        self.write_journal({"op": "redo"})
+        self.show_history(*result)
+
+    def show_history(self, step, changed):
+        if "replace" in step:
+            # 矩形の数が変わるのでキャンバスと表を作り直す
+            self.create_box_items()
+            self.update_tag_table()
+        else:
+            self.refresh_boxes(changed)
+
+    def page_snapshot(self):
+        return self.model.snapshot()
+
+    def start_journal(self):
+        # ページの内容が確定したところでスナップショットを書き、以降の変更はログに追記する
+        self.close_journal()
+        if self.image_path is None:
+            return
+        self.journal = AnnotationJournal(self.image_path)
+        self.journal.compact(self.page_snapshot())
+
+    def write_journal(self, entry):
+        if self.journal is None:
+            return
+        self.journal.append(entry)
+        if self.journal.ops_since_compact >= JOURNAL_COMPACT_OPS:
+            self.journal.compact(self.page_snapshot())
+
+    def flush_journal(self):
+        if self.journal is not None:
+            self.journal.flush()
+        self.root.after(JOURNAL_FLUSH_MS, self.flush_journal)
+
+    def close_journal(self):
+        # 保存済みで変更のないページの作業ログは残さない
+        if self.journal is not None:
+            if self.journal.unsaved:
+                self.journal.compact(self.page_snapshot())
+                self.journal.close()
+            else:
+                self.journal.discard()
+            self.journal = None
+
+    def restore_journal(self, journal):
+        # スナップショットを読み込み、その後の操作を順に再生する
+        snapshot, entries = journal.load()
+        self.model.restore(snapshot, entries)
+        self.create_box_items()
+        self.update_tag_table()
+        self.journal = journal
+        journal.unsaved = True  # 復元した内容はまだ保存されていない
+        journal.compact(self.page_snapshot())
+        self.ocr_status_label.config(text="OCR: 作業ログから復元", fg="green")
 
     def save_tags(self):
-        data = {
-            "image_path": self.image_path,
-            "scale": self.scale,  # スケール情報を保存
-            "items": []
-        }
-        for item in self.text_boxes:
-            box = item["box"]
-            x1, y1 = box[0]  # 左上の座標
-            x2, y2 = box[1]  # 右下の座標
-            if x1 > x2 or y1 > y2:  # 座標が逆転している場合を修正
-                x1, x2 = min(x1, x2), max(x1, x2)
-                y1, y2 = min(y1, y2), max(y1, y2)
-            data["items"].append({
-                "text": item["text"],
-                "box": [[x1, y1], [x2, y2]],  # 左上と右下の形式に修正
-                "tag": item["tag"],
-                "score": item["score"]  # スコアを保存
-            })
         path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
         if path:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with perf.span("save", boxes=len(self.boxes)):
+                self.model.save(path)
+            if self.journal is not None:
+                # 保存できたので、ここから先の変更だけを未保存として扱う
+                self.journal.unsaved = False
+                self.journal.compact(self.page_snapshot())
+            # 保存したページはすぐに検索・類似ページの照合に使えるようにする
+            page_hash_info = None
+            if self.pyramid is not None:
+                page_hash_info = (page_hash(self.pyramid.levels[-1]), (self.pyramid.width, self.pyramid.height))
+            # 索引に登録できなくても保存自体は済んでいるので、失敗は表示だけにする
+            try:
+                self.get_annotation_index().ingest_file(path, page_hash_info=page_hash_info)
+            except (sqlite3.Error, OSError) as e:
+                print("保存したページを索引に登録できませんでした:", e)
             messagebox.showinfo("保存完了", f"{path} に保存しました。")
 
-    def load_saved_data(self):
-        path = filedialog.askopenfilename(filetypes=[("JSON", "*.json")])
+    @perf.timed("load")
+    def load_saved_data(self, path=None):
+        if path is None:
+            path = filedialog.askopenfilename(filetypes=[("JSON", "*.json")])
         if not path:
             return
 
         with open(path, "r", encoding="utf-8") as f:
             saved_data = json.load(f)
 
-        self.text_boxes.clear()
-        self.canvas.delete("all")  # キャンバスをリセット
+        self.cancel_ocr()  # 実行中のOCR結果で読み込んだデータが上書きされないようにする
+        self.close_journal()
         self.canvas.xview_moveto(0)  # 水平方向のスクロール位置をリセット
         self.canvas.yview_moveto(0)  # 垂直方向のスクロール位置をリセット
-        self.scale = 1.0  # ズームをリセット
+        self.model.load_data(saved_data)  # スケール情報と矩形を読み込む
 
         img_path = saved_data.get("image_path")
         if img_path and os.path.exists(img_path):
-            image = Image.open(img_path)
-            self.tk_image = ImageTk.PhotoImage(image)
-            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-            self.image_path = img_path
+            self.set_image(img_path)
         else:
+            self.clear_image()
             messagebox.showwarning("画像ファイルが見つかりません", "保存された画像ファイルが見つかりませんでした。")
 
-        self.canvas.xview_moveto(0)  # 水平方向のスクロール位置をリセット
-        self.canvas.yview_moveto(0)  # 垂直方向のスクロール位置をリセット
-        self.scale = 1.0  # ズームをリセット
-
-        self.scale = saved_data.get("scale", 1.0)  # スケール情報を読み込む
-
-        # 画像を再描画
-        image = Image.open(self.image_path)
-        new_size = (int(image.width * self.scale), int(image.height * self.scale))
-        resized_image = image.resize(new_size, Image.Resampling.LANCZOS)
-        self.tk_image = ImageTk.PhotoImage(resized_image)
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-
-        for item in saved_data["items"]:
-            box = item["box"]
-            x1, y1 = box[0]  # 左上の座標
-            x2, y2 = box[1]  # 右下の座標
-            color = self.tag_colors.get(item["tag"], "gray")
-
-            rect_id = self.canvas.create_rectangle(
-                x1 * self.scale, y1 * self.scale,
-                x2 * self.scale, y2 * self.scale,
-                outline=color, width=2, tags="box"
-            )
-            text_id = self.canvas.create_text(
-                x1 * self.scale, y1 * self.scale - 3,
-                text=item["text"], anchor=tk.SW, fill=color, font=("Arial", 10, "bold")
-            )
-            tag_id = self.canvas.create_text(
-                x2 * self.scale, y2 * self.scale + 3,
-                text=item["tag"], anchor=tk.NE, fill=color, font=("Arial", 10, "bold")
-            )
-
-            self.text_boxes.append({
-                "text": item["text"],
-                "box": [[x1, y1], [x2, y2]],
-                "tag": item["tag"],
-                "score": item.get("score", 0.0),  # スコアを読み込む。デフォルトは0.0
-                "rect_id": rect_id,
-                "text_id": text_id,
-                "tag_id": tag_id
-            })
-
+        self.create_box_items()
         self.update_tag_table()  # 読み込み後に表を更新
+        self.start_journal()
 
     def edit_tags(self):
         tag_win = tk.Toplevel(self.root)
@@ -314,6 +2750,8 @@ class BIFTagger:
                 if tag not in self.tag_colors:
                     self.tag_colors[tag] = color
                     self.update_tag_buttons()
+                    for table in self.tag_tables:
+                        table.update_tag_choices()
                     self.save_tags_to_file()
                     messagebox.showinfo("追加完了", f"タグ '{tag}' を追加しました")
                 else:
@@ -340,7 +2778,7 @@ class BIFTagger:
             json.dump(self.tag_colors, f, ensure_ascii=False, indent=2)
 
     def zoom_image(self, event):
-        if self.image_path is None:
+        if self.pyramid is None:
             return
 
         # 拡大・縮小の倍率を設定
@@ -350,163 +2788,597 @@ class BIFTagger:
         elif event.delta < 0:  # ホイールダウンで縮小
             self.scale = max(self.scale - scale_step, 0.1)  # スケールが0以下にならないように
 
-        # 画像を再描画
-        image = Image.open(self.image_path)
-        new_size = (int(image.width * self.scale), int(image.height * self.scale))
-        resized_image = image.resize(new_size, Image.Resampling.LANCZOS)
-        self.tk_image = ImageTk.PhotoImage(resized_image)
-        self.canvas.delete("all")
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-
-        # OCRで検出された矩形も再描画
-        for item in self.text_boxes:
-            box = item["box"]
-            x1, y1 = box[0]  # 左上の座標
-            x2, y2 = box[1]  # 右下の座標
-
-            scaled_box = [
-                x1 * self.scale,
-                y1 * self.scale,
-                x2 * self.scale,
-                y2 * self.scale
-            ]
-
-            color = self.tag_colors.get(item["tag"], "gray")
-            rect_id = self.canvas.create_rectangle(
-                scaled_box[0], scaled_box[1],
-                scaled_box[2], scaled_box[3],
-                outline=color, width=2, tags="box"
-            )
-            text_id = self.canvas.create_text(
-                scaled_box[0], scaled_box[1] - 3,
-                text=item["text"], anchor=tk.SW, fill=color, font=("Arial", 10, "bold")
-            )
-            tag_id = self.canvas.create_text(
-                scaled_box[2], scaled_box[3] + 3,
-                text=item["tag"], anchor=tk.NE, fill=color, font=("Arial", 10, "bold")
-            )
-            item.update({"rect_id": rect_id, "text_id": text_id, "tag_id": tag_id})
-
+        # 連続したホイールイベントはまとめて1回だけ描画する
+        if self.zoom_after is None:
+            self.zoom_after = self.root.after(ZOOM_PREVIEW_DELAY_MS, self.render_zoom_preview)
+
+    @perf.timed("zoom.preview")
+    def render_zoom_preview(self):
+        self.zoom_after = None
+        if self.refine_after is not None:
+            self.root.after_cancel(self.refine_after)
+            self.refine_after = None
+        # 操作中は低品質で素早く描画し、ズームが止まってからLANCZOSで描き直す
+        cached = self.pyramid.is_cached(self.scale)
+        self.render_image(preview=True)
+        self.layout_boxes()
+        if not cached:
+            self.refine_after = self.root.after(ZOOM_REFINE_DELAY_MS, self.refine_zoom)
+
+    @perf.timed("zoom.refine")
+    def refine_zoom(self):
+        self.refine_after = None
+        self.render_image()
+
+    def cancel_zoom_render(self):
+        if self.zoom_after is not None:
+            self.root.after_cancel(self.zoom_after)
+            self.zoom_after = None
+        if self.refine_after is not None:
+            self.root.after_cancel(self.refine_after)
+            self.refine_after = None
+
+    @perf.timed("fit_to_canvas")
     def fit_to_canvas(self):
-        if self.image_path is None:
+        if self.pyramid is None:
             return
 
-        image = Image.open(self.image_path)
         canvas_width = self.canvas.winfo_width()
         canvas_height = self.canvas.winfo_height()
+        self.scale = fit_scale(self.pyramid.width, self.pyramid.height, canvas_width, canvas_height)
 
-        scale_x = canvas_width / image.width
-        scale_y = canvas_height / image.height
-        self.scale = min(scale_x, scale_y)
-
-        # 画像を再描画
-        new_size = (int(image.width * self.scale), int(image.height * self.scale))
-        resized_image = image.resize(new_size, Image.Resampling.LANCZOS)
-        self.tk_image = ImageTk.PhotoImage(resized_image)
-        self.canvas.delete("all")
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-
-        # OCRで検出された矩形も再描画
-        for item in self.text_boxes:
-            box = item["box"]
-            x1, y1 = box[0]  # 左上の座標
-            x2, y2 = box[1]  # 右下の座標
-
-            scaled_box = [
-                x1 * self.scale,
-                y1 * self.scale,
-                x2 * self.scale,
-                y2 * self.scale
-            ]
-
-            color = self.tag_colors.get(item["tag"], "gray")
-            rect_id = self.canvas.create_rectangle(
-                scaled_box[0], scaled_box[1],
-                scaled_box[2], scaled_box[3],
-                outline=color, width=2, tags="box"
-            )
-            text_id = self.canvas.create_text(
-                scaled_box[0], scaled_box[1] - 3,
-                text=item["text"], anchor=tk.SW, fill=color, font=("Arial", 10, "bold")
-            )
-            tag_id = self.canvas.create_text(
-                scaled_box[2], scaled_box[3] + 3,
-                text=item["tag"], anchor=tk.NE, fill=color, font=("Arial", 10, "bold")
-            )
-            item.update({"rect_id": rect_id, "text_id": text_id, "tag_id": tag_id})
+        # 画像と矩形を再描画
+        self.cancel_zoom_render()
+        self.render_image()
+        self.layout_boxes()
 
     def show_tag_table(self):
         table_window = tk.Toplevel(self.root)
         table_window.title("タグ情報")
 
-        frame = tk.Frame(table_window)
-        frame.pack(fill=tk.BOTH, expand=True)
-
-        canvas = tk.Canvas(frame)
-        scrollbar = tk.Scrollbar(frame, orient=tk.VERTICAL, command=canvas.yview)
-        scrollable_frame = tk.Frame(canvas)
-
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-        )
-
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-
-        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
-        # ヘッダー行
-        headers = ["X1", "Y1", "文字列", "タグ名"]
-        for col, header in enumerate(headers):
-            tk.Label(scrollable_frame, text=header, borderwidth=1, relief="solid", width=15).grid(row=0, column=col)
-
-        # データ行
-        for row, item in enumerate(self.text_boxes, start=1):
-            x1, y1 = item["box"][0]
-            tk.Label(scrollable_frame, text=f"{x1:.2f}", borderwidth=1, relief="solid", width=15).grid(row=row, column=0)
-            tk.Label(scrollable_frame, text=f"{y1:.2f}", borderwidth=1, relief="solid", width=15).grid(row=row, column=1)
-            tk.Label(scrollable_frame, text=item["text"], borderwidth=1, relief="solid", width=15).grid(row=row, column=2)
-            tk.Label(scrollable_frame, text=item["tag"], borderwidth=1, relief="solid", width=15).grid(row=row, column=3)
+        table = TagTable(table_window, self, ("x1", "y1", "text", "tag"))
+        self.tag_tables.append(table)
+        table.reload()
+        table_window.bind("<Destroy>", lambda e: e.widget is table_window and self.tag_tables.remove(table))
 
         table_window.geometry("600x400")
 
+    def show_search(self):
+        self.get_annotation_index()
+        search_window = tk.Toplevel(self.root)
+        search_window.title("アノテーション検索")
+
+        form = tk.Frame(search_window)
+        form.pack(fill=tk.X)
+        tk.Label(form, text="テキスト:").pack(side=tk.LEFT)
+        text_entry = tk.Entry(form, width=20)
+        text_entry.pack(side=tk.LEFT)
+        tk.Label(form, text="タグ:").pack(side=tk.LEFT)
+        tag_choice = ttk.Combobox(form, state="readonly", width=10, values=[""] + list(self.tag_colors))
+        tag_choice.pack(side=tk.LEFT)
+        tk.Label(form, text="最大スコア:").pack(side=tk.LEFT)
+        score_entry = tk.Entry(form, width=6)
+        score_entry.pack(side=tk.LEFT)
+        status_label = tk.Label(search_window, text="", anchor="w")
+
+        columns = ("file", "text", "tag", "score")
+        tree = ttk.Treeview(search_window, columns=columns, show="headings")
+        for column, heading, width in zip(columns, ("ファイル", "テキスト", "タグ", "スコア"), (240, 200, 80, 60)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width)
+        results = {}
+
+        def run_search(event=None):
+            try:
+                max_score = float(score_entry.get()) if score_entry.get().strip() else None
+            except ValueError:
+                messagebox.showwarning("入力エラー", "最大スコアには数値を入力してください", parent=search_window)
+                return
+            rows = self.annotation_index.search(text=text_entry.get().strip() or None,
+                                                tag=tag_choice.get() or None, max_score=max_score)
+            tree.delete(*tree.get_children())
+            results.clear()
+            for row in rows:
+                json_path, _, _, text, tag, score = row
+                iid = tree.insert("", tk.END, values=(os.path.basename(json_path), text, tag, f"{score:.2f}"))
+                results[iid] = json_path
+            status_label.config(text=f"{len(rows)}件")
+
+        def open_result(event):
+            iid = tree.identify_row(event.y)
+            if iid in results:
+                self.load_saved_data(results[iid])
+
+        def ingest_folder():
+            folder = filedialog.askdirectory(parent=search_window)
+            if not folder:
+                return
+            status_label.config(text="取り込み中...")
+
+            def ingest():
+                # SQLiteの接続はスレッドごとに作る
+                index = AnnotationIndex(self.db_path)
+                try:
+                    return index.ingest_dir(folder)
+                finally:
+                    index.close()
+
+            def done(future):
+                if not search_window.winfo_exists():
+                    return
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    status_label.config(text=f"取り込み失敗: {e}")
+                    return
+                if self.annotation_index is not None:
+                    self.annotation_index.invalidate_page_hashes()
+                status_label.config(text=f"追加 {stats['added']} / 更新 {stats['updated']} / "
+                                         f"変更なし {stats['unchanged']} / 削除 {stats['removed']}")
+
+            self.watch_future(self.io_executor.submit(ingest), done)
+
+        tk.Button(form, text="検索", command=run_search).pack(side=tk.LEFT)
+        tk.Button(form, text="フォルダを取り込む", command=ingest_folder).pack(side=tk.LEFT)
+        text_entry.bind("<Return>", run_search)
+        tree.bind("<Double-1>", open_result)
+        tree.pack(fill=tk.BOTH, expand=True)
+        status_label.pack(fill=tk.X)
+        search_window.geometry("640x400")
+
+    @perf.timed("update_tag_table")
     def update_tag_table(self):
-        for widget in self.table_inner_frame.winfo_children():
-            widget.destroy()
-
-        headers = ["X1,Y1", "テキスト", "タグ", "スコア"]  # ヘッダーを変更
-        for col, header in enumerate(headers):
-            tk.Label(self.table_inner_frame, text=header, borderwidth=1, relief="solid", width=15).grid(row=0, column=col)
-
-        for row, item in enumerate(self.text_boxes, start=1):
-            x1, y1 = item["box"][0]
-            color = self.tag_colors.get(item["tag"], "black")  # タグの色を取得
-
-            # X1, Y1 を1つのセルにまとめて整数で表示
-            tk.Label(self.table_inner_frame, text=f"({int(x1)}, {int(y1)})", borderwidth=1, relief="solid", width=15, fg=color).grid(row=row, column=0)
-
-            # テキストを編集可能に
-            text_entry = tk.Entry(self.table_inner_frame, width=15, fg=color)
-            text_entry.insert(0, item["text"])
-            text_entry.grid(row=row, column=1)
-
-            def update_text(event, item=item, entry=text_entry):
-                new_text = entry.get()
-                item["text"] = new_text
-                self.canvas.itemconfig(item["text_id"], text=new_text)
-
-            text_entry.bind("<FocusOut>", update_text)
+        # ページ全体が変わったときに全ての一覧を入れ直す
+        for table in self.tag_tables:
+            table.reload()
+
+    @perf.timed("update_tag_rows")
+    def update_tag_rows(self, indices):
+        for table in self.tag_tables:
+            for index in indices:
+                table.update_row(index)
+
+    def update_text(self, index, new_text):
+        old_text = self.boxes.texts[index]
+        if new_text == old_text:
+            return
+        self.boxes.set_text(index, new_text)
+        self.record_step({"texts": [[index, old_text, new_text]]})
+        self.refresh_boxes([index])
+
+
+def iter_image_files(input_dir, recursive=True):
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(dirpath, name)
+        if not recursive:
+            break
+
+
+def _hash_one(path):
+    try:
+        value, size = page_hash_file(path)
+        return path, value, size, None
+    except Exception as e:
+        return path, None, None, repr(e)
+
+
+def run_dedup(input_dir, report_path=None, max_distance=PAGE_HASH_MAX_DISTANCE, workers=1, recursive=True,
+              db_path=None):
+    # フォルダ内の画像をハッシュでグループ分けし、各グループの先頭以外(と保存済みのページに似たもの)を報告する
+    paths = list(iter_image_files(input_dir, recursive))
+    annotation_index = AnnotationIndex(db_path) if db_path and os.path.exists(db_path) else None
+    index = PageHashIndex()
+    groups = []  # グループ番号 -> 代表の画像
+    rows = []
+    failed = 0
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(max(1, workers)) as pool:
+        for path, value, size, error in pool.imap(_hash_one, paths, chunksize=16):
+            if error is not None:
+                failed += 1
+                print(f"失敗: {path}: {error}")
+                continue
+            matches = index.search(value, max_distance)
+            if matches:
+                distance, group = matches[0]
+            else:
+                distance, group = 0, len(groups)
+                groups.append(path)
+            index.add(value, group)
+            annotated = ""
+            if annotation_index is not None:
+                similar = annotation_index.similar_pages(value, max_distance)
+                if similar:
+                    annotated = similar[0][1]
+            rows.append((group, path, groups[group], distance, annotated))
+    if annotation_index is not None:
+        annotation_index.close()
+    elapsed = time.perf_counter() - start
+
+    out = open(report_path, "w", encoding="utf-8", newline="") if report_path else sys.stdout
+    try:
+        out.write("group\tpath\trepresentative\tdistance\tannotated_json\n")
+        for row in sorted(rows):
+            out.write("\t".join(str(value) for value in row) + "\n")
+    finally:
+        if report_path:
+            out.close()
+    duplicates = len(rows) - len(groups)
+    reusable = sum(1 for row in rows if row[4])
+    print(f"{len(rows)}枚 -> {len(groups)}グループ, 重複 {duplicates}枚, 保存済みページに類似 {reusable}枚, "
+          f"失敗 {failed}枚 ({elapsed:.1f}秒)", file=sys.stderr)
+    return {"pages": len(rows), "groups": len(groups), "duplicates": duplicates, "annotated": reusable,
+            "failed": failed}
+
+
+def batch_output_path(image_path, input_dir, output_dir):
+    rel = os.path.relpath(image_path, input_dir)
+    return os.path.join(output_dir, os.path.splitext(rel)[0] + ".json")
+
+
+def reading_order(items):
+    # 縦方向に重なる矩形を同じ行とみなし、行は上から、行内は左から並べる
+    ordered = sorted(items, key=lambda item: (item["box"][0][1] + item["box"][1][1]) / 2)
+    lines = []
+    for item in ordered:
+        y1, y2 = item["box"][0][1], item["box"][1][1]
+        if lines:
+            line = lines[-1]
+            overlap = min(y2, line["y2"]) - max(y1, line["y1"])
+            if overlap >= 0.5 * min(y2 - y1, line["y2"] - line["y1"]):
+                line["items"].append(item)
+                line["y1"] = min(line["y1"], y1)
+                line["y2"] = max(line["y2"], y2)
+                continue
+        lines.append({"y1": y1, "y2": y2, "items": [item]})
+    return [item for line in lines for item in sorted(line["items"], key=lambda item: item["box"][0][0])]
+
+
+def bio_tokens(items, unit="char"):
+    # unit="char"なら1文字ずつ、"box"なら矩形ごとにB-/I-/Oのラベルを付ける
+    tokens = []
+    labels = []
+    for item in items:
+        tag = item["tag"]
+        pieces = list(item["text"]) if unit == "char" else [item["text"]]
+        first = True
+        for piece in pieces:
+            if not piece.strip():
+                continue  # 空白はトークンにしない
+            tokens.append(piece)
+            if tag == "O":
+                labels.append("O")
+            else:
+                labels.append(("B-" if first else "I-") + tag)
+            first = False
+    return tokens, labels
+
+
+def iter_annotation_files(input_dir):
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(".json"):
+                yield os.path.join(dirpath, name)
+
+
+def _export_one(task):
+    # ワーカープロセスで1ファイルを変換し、書き出す文字列を返す(読み込みは1ファイルずつ)
+    json_path, fmt, unit, skip_untagged = task
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = check_save_data(json.load(f))  # 形式の違うファイルはスキップとして数える
+    except (OSError, ValueError) as e:
+        print(f"読み込み失敗: {json_path}: {e}")
+        return None
+    items = reading_order(data["items"])
+    if skip_untagged and all(item["tag"] == "O" for item in items):
+        return None
+    tokens, labels = bio_tokens(items, unit)
+    if fmt == "bio":
+        return "".join(f"{token}\t{label}\n" for token, label in zip(tokens, labels)) + "\n"
+    record = {
+        "source": json_path,
+        "image_path": data.get("image_path"),
+        "tokens": tokens,
+        "labels": labels,
+    }
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+class ShardWriter:
+    # shard_size件ごとに出力ファイルを切り替える
+    def __init__(self, output_dir, prefix, extension, shard_size):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.extension = extension
+        self.shard_size = shard_size
+        self.shard = -1
+        self.count = 0
+        self._file = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, text):
+        if self._file is None or self.count >= self.shard_size:
+            self.close()
+            self.shard += 1
+            self.count = 0
+            path = os.path.join(self.output_dir, f"{self.prefix}-{self.shard:05d}.{self.extension}")
+            self._file = open(path, "w", encoding="utf-8")
+        self._file.write(text)
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def run_export(input_dir, output_dir, fmt="jsonl", unit="char", shard_size=10000, workers=1,
+               skip_untagged=False, prefix="train", report_every=1000):
+    # ファイル一覧も結果もストリームで処理し、同時に扱う件数を一定に抑えるのでコーパスの大きさによらずメモリは一定
+    tasks = ((path, fmt, unit, skip_untagged) for path in iter_annotation_files(input_dir))
+    writer = ShardWriter(output_dir, prefix, "jsonl" if fmt == "jsonl" else "bio", shard_size)
+    window = max(1, workers) * 64
+    written = 0
+    skipped = 0
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(max(1, workers)) as pool:
+        while True:
+            chunk = list(itertools.islice(tasks, window))
+            if not chunk:
+                break
+            for text in pool.imap(_export_one, chunk, chunksize=16):
+                if text is None:
+                    skipped += 1
+                    continue
+                writer.write(text)
+                written += 1
+                if written % report_every == 0:
+                    print(f"{written}件 {written / (time.perf_counter() - start):.1f} docs/sec")
+    writer.close()
+    elapsed = time.perf_counter() - start
+    docs_per_sec = written / elapsed if elapsed > 0 else 0.0
+    print(f"出力: {written}件 (スキップ: {skipped}件), シャード: {writer.shard + 1}個, "
+          f"{elapsed:.1f}秒 ({docs_per_sec:.1f} docs/sec)")
+    return {"written": written, "skipped": skipped, "shards": writer.shard + 1, "docs_per_sec": docs_per_sec}
+
+
+_batch_engine = None  # バッチ用ワーカープロセスごとのOCRエンジン
+_batch_pretagger = None
+_tile_image = None  # 分割OCRのワーカーでデコード済みのページ(パス, 画像)
+
+
+def _batch_worker_init(lang, use_angle_cls, cache_dir, pretag_rules=None):
+    global _batch_engine, _batch_pretagger
+    cache = OCRCache(cache_dir) if cache_dir else None
+    _batch_engine = OCREngine(lang=lang, use_angle_cls=use_angle_cls, cache=cache)
+    _batch_engine.get()
+    if pretag_rules is not None:
+        _batch_pretagger = PreTagger.load(pretag_rules)
+
+
+def _write_batch_output(image_path, out_path, items, pretagger=None):
+    if pretagger is not None:
+        pretagger.apply_items(items)
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    write_json_atomic(out_path, build_save_data(os.path.abspath(image_path), 1.0, items))
+
+
+def _batch_ocr_one(task):
+    image_path, out_path = task
+    try:
+        result = _batch_engine.ocr(image_path, cls=True)
+        items = ocr_lines_to_items(result[0])
+        _write_batch_output(image_path, out_path, items, _batch_pretagger)
+        return image_path, len(items), None
+    except Exception as e:
+        return image_path, 0, repr(e)
+
+
+def _tile_ocr_one(task):
+    # 同じページのタイルが続けて来るので、デコードした画像はワーカー内で使い回す
+    global _tile_image
+    path, tile, cls = task
+    if _tile_image is None or _tile_image[0] != path:
+        _tile_image = None
+        image = Image.open(path)
+        image.load()
+        _tile_image = (path, image)
+    return region_ocr_items(_batch_engine, _tile_image[1], tile, padding=0, max_upscale=1.0, cls=cls)
+
+
+def run_batch(input_dir, output_dir, workers=1, recursive=True, cache_dir=OCR_CACHE_DIR,
+              lang=OCR_LANG, use_angle_cls=OCR_USE_ANGLE_CLS, report_every=10, pretag_rules=None,
+              tiled=False, tile_size=TILED_OCR_TILE_SIZE, tile_overlap=TILED_OCR_OVERLAP, tile_compare=False):
+    # 出力済みのJSONがある画像は飛ばすので、中断しても同じコマンドで再開できる
+    tasks = []
+    large_tasks = []  # tiled=Trueのとき、タイルに分けて全ワーカーでOCRするページ
+    skipped = 0
+    for image_path in iter_image_files(input_dir, recursive):
+        out_path = batch_output_path(image_path, input_dir, output_dir)
+        if os.path.exists(out_path):
+            skipped += 1
+            continue
+        if tiled:
+            try:
+                with Image.open(image_path) as image:
+                    width, height = image.size
+            except OSError:
+                width = height = 0  # 読めない画像は通常の処理で失敗として数える
+            if width * height > TILED_OCR_MIN_PIXELS:
+                large_tasks.append((image_path, out_path))
+                continue
+        tasks.append((image_path, out_path))
+    print(f"対象: {len(tasks) + len(large_tasks)}枚 (うち分割OCR: {len(large_tasks)}枚, "
+          f"処理済みのためスキップ: {skipped}枚), ワーカー数: {workers}")
+    total = len(tasks) + len(large_tasks)
+    if not total:
+        return {"done": 0, "failed": 0, "skipped": skipped, "pages_per_sec": 0.0}
+
+    pretagger = None
+    if pretag_rules is not None:
+        # ルールの誤りはワーカーを起動する前に分かるようにする(各ワーカーでも読み込む)
+        pretagger = PreTagger.load(pretag_rules)
+        print(pretagger.summary())
+
+    done = 0
+    failed = 0
+    start = time.perf_counter()
+    # paddleはforkと相性が悪いのでspawnでワーカーを起動する
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=_batch_worker_init,
+                  initargs=(lang, use_angle_cls, cache_dir, pretag_rules)) as pool:
+        for image_path, count, error in pool.imap_unordered(_batch_ocr_one, tasks):
+            if error is None:
+                done += 1
+            else:
+                failed += 1
+                print(f"失敗: {image_path}: {error}")
+            processed = done + failed
+            if processed % report_every == 0 or processed == total:
+                elapsed = time.perf_counter() - start
+                print(f"{processed}/{total}枚 {processed / elapsed:.2f} pages/sec")
+
+        if large_tasks:
+            # 大きなページは1枚ずつ、タイルを同じワーカーたちに分けて並列にOCRする
+            cache = OCRCache(cache_dir) if cache_dir else None
+            tiler = TiledOCR(OCREngine(lang=lang, use_angle_cls=use_angle_cls, cache=cache), workers=workers,
+                             tile_size=tile_size, overlap=tile_overlap, compare=tile_compare, pool=pool)
+            for image_path, out_path in large_tasks:
+                try:
+                    items = ocr_lines_to_items(tiler.ocr(image_path)[0])
+                    _write_batch_output(image_path, out_path, items, pretagger)
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"失敗: {image_path}: {e!r}")
+    elapsed = time.perf_counter() - start
+    pages_per_sec = (done + failed) / elapsed if elapsed > 0 else 0.0
+    print(f"完了: {done}枚, 失敗: {failed}枚, {elapsed:.1f}秒 ({pages_per_sec:.2f} pages/sec)")
+    return {"done": done, "failed": failed, "skipped": skipped, "pages_per_sec": pages_per_sec}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OCR BIFタグ付けツール")
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch_parser = subparsers.add_parser("batch", help="フォルダ内の画像をまとめてOCRし、JSONを出力する")
+    batch_parser.add_argument("input_dir")
+    batch_parser.add_argument("output_dir")
+    batch_parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    batch_parser.add_argument("--no-recursive", action="store_true", help="サブフォルダを対象にしない")
+    batch_parser.add_argument("--cache-dir", default=OCR_CACHE_DIR, help="空文字でキャッシュを使わない")
+    batch_parser.add_argument("--lang", default=OCR_LANG)
+    batch_parser.add_argument("--pretag", action="store_true", help="OCR後に自動タグ付けを行う")
+    batch_parser.add_argument("--pretag-rules", default=PRETAG_RULES_FILE)
+    batch_parser.add_argument("--tiled", action="store_true", help="大きなページをタイルに分けて並列にOCRする")
+    batch_parser.add_argument("--tile-size", type=int, default=TILED_OCR_TILE_SIZE)
+    batch_parser.add_argument("--tile-overlap", type=int, default=TILED_OCR_OVERLAP)
+    batch_parser.add_argument("--tile-compare", action="store_true", help="分割しないOCRも実行して速度を比べる")
+
+    index_parser = subparsers.add_parser("index", help="保存済みJSONをSQLiteの索引に取り込む(変更分のみ)")
+    index_parser.add_argument("json_dir")
+    index_parser.add_argument("--db", default=ANNOTATION_DB)
+
+    query_parser = subparsers.add_parser("query", help="索引からタグや文字列で検索する")
+    query_parser.add_argument("--db", default=ANNOTATION_DB)
+    query_parser.add_argument("--text", help="OCRテキストの部分一致")
+    query_parser.add_argument("--tag")
+    query_parser.add_argument("--min-score", type=float)
+    query_parser.add_argument("--max-score", type=float)
+    query_parser.add_argument("--counts", action="store_true", help="タグごとの件数を表示する")
+    query_parser.add_argument("--pages", action="store_true", help="矩形ではなくページ単位で表示する")
+    query_parser.add_argument("--limit", type=int, default=100)
+
+    dedup_parser = subparsers.add_parser("dedup", help="フォルダ内のほぼ同じページ(再スキャン・コピー)を報告する")
+    dedup_parser.add_argument("input_dir")
+    dedup_parser.add_argument("-o", "--output", help="TSVの出力先(省略時は標準出力)")
+    dedup_parser.add_argument("--max-distance", type=int, default=PAGE_HASH_MAX_DISTANCE)
+    dedup_parser.add_argument("--db", default=ANNOTATION_DB, help="保存済みページとの照合に使う索引")
+    dedup_parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    dedup_parser.add_argument("--no-recursive", action="store_true", help="サブフォルダを対象にしない")
+
+    export_parser = subparsers.add_parser("export", help="保存済みJSONを学習データ(BIO/JSONL)に変換する")
+    export_parser.add_argument("json_dir")
+    export_parser.add_argument("output_dir")
+    export_parser.add_argument("--format", choices=("jsonl", "bio"), default="jsonl")
+    export_parser.add_argument("--unit", choices=("char", "box"), default="char", help="トークンの単位")
+    export_parser.add_argument("--shard-size", type=int, default=10000, help="1ファイルあたりの文書数")
+    export_parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    export_parser.add_argument("--skip-untagged", action="store_true", help="タグが全てOのページを出力しない")
+    export_parser.add_argument("--prefix", default="train")
+
+    parser.add_argument("--db", default=ANNOTATION_DB, help="検索画面で使う索引")
+    parser.add_argument("--work-dir", help="起動時に作業フォルダとして開くフォルダ")
+    parser.add_argument("--prefetch-depth", type=int, default=PREFETCH_DEPTH, help="作業フォルダで先読みする枚数")
+    parser.add_argument("--prefetch-mb", type=int, default=PREFETCH_MAX_BYTES // (1024 * 1024),
+                        help="先読みした画像に使うメモリの上限(MB)")
+    parser.add_argument("--tile-size", type=int, default=TILED_OCR_TILE_SIZE, help="大判分割OCRのタイルの大きさ")
+    parser.add_argument("--tile-overlap", type=int, default=TILED_OCR_OVERLAP, help="大判分割OCRのタイルの重なり")
+    parser.add_argument("--tile-workers", type=int, default=TILED_OCR_WORKERS, help="大判分割OCRのプロセス数")
+    parser.add_argument("--tile-compare", action="store_true", help="分割しないOCRも実行して速度を比べる")
+    parser.add_argument("--trace", help="終了時に処理ごとの所要時間をこのJSONLファイルに書き出す")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        run_batch(args.input_dir, args.output_dir, workers=max(1, args.workers),
+                  recursive=not args.no_recursive, cache_dir=args.cache_dir, lang=args.lang,
+                  pretag_rules=args.pretag_rules if args.pretag else None, tiled=args.tiled,
+                  tile_size=args.tile_size, tile_overlap=args.tile_overlap, tile_compare=args.tile_compare)
+        return
+
+    if args.command == "dedup":
+        run_dedup(args.input_dir, args.output, max_distance=args.max_distance, workers=args.workers,
+                  recursive=not args.no_recursive, db_path=args.db)
+        return
+
+    if args.command == "export":
+        run_export(args.json_dir, args.output_dir, fmt=args.format, unit=args.unit,
+                   shard_size=max(1, args.shard_size), workers=args.workers,
+                   skip_untagged=args.skip_untagged, prefix=args.prefix)
+        return
+
+    if args.command == "index":
+        index = AnnotationIndex(args.db)
+        start = time.perf_counter()
+        stats = index.ingest_dir(args.json_dir)
+        index.close()
+        print(f"追加 {stats['added']} / 更新 {stats['updated']} / 変更なし {stats['unchanged']} / "
+              f"削除 {stats['removed']} / 失敗 {stats['failed']} ({time.perf_counter() - start:.1f}秒)")
+        return
+
+    if args.command == "query":
+        index = AnnotationIndex(args.db)
+        if args.counts:
+            for tag, count in index.tag_counts():
+                print(f"{tag}\t{count}")
+        elif args.pages:
+            for json_path, image_path, count in index.pages(args.text, args.tag, args.min_score, args.max_score,
+                                                            args.limit):
+                print(f"{count}\t{json_path}\t{image_path}")
+        else:
+            for json_path, _, idx, text, tag, score in index.search(args.text, args.tag, args.min_score,
+                                                                    args.max_score, args.limit):
+                print(f"{json_path}#{idx}\t{tag}\t{score:.2f}\t{text}")
+        index.close()
+        return
 
-            # タグ名
-            tk.Label(self.table_inner_frame, text=item["tag"], borderwidth=1, relief="solid", width=15, fg=color).grid(row=row, column=2)
+    root = tk.Tk()
+    tiled_ocr = TiledOCR(ocr, workers=max(1, args.tile_workers), tile_size=args.tile_size,
+                         overlap=args.tile_overlap, compare=args.tile_compare)
+    app = BIFTagger(root, prefetch_depth=max(0, args.prefetch_depth),
+                    prefetch_max_bytes=args.prefetch_mb * 1024 * 1024, db_path=args.db, tiled_ocr=tiled_ocr,
+                    trace_path=args.trace)
+    root.protocol("WM_DELETE_WINDOW", app.close)
+    if args.work_dir:
+        root.after_idle(lambda: app.set_work_files(list(iter_image_files(args.work_dir))))
+    root.mainloop()
 
-            # スコア
-            tk.Label(self.table_inner_frame, text=f"{item['score']:.2f}", borderwidth=1, relief="solid", width=15, fg=color).grid(row=row, column=3)
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = BIFTagger(root)
-    root.protocol("WM_DELETE_WINDOW", lambda: (app.save_tags_to_file(), root.destroy()))
-    root.mainloop()
+    main()
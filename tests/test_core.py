@@ -0,0 +1,402 @@
+"""画面を使わない主な処理のテスト。
+
+    python -m pytest -q
+
+PaddleOCRは使わないので、paddleocrがなくても実行できる。
+"""
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from PIL import Image  # noqa: E402
+
+import ocr_tagger  # noqa: E402
+from bench_core import find_regressions  # noqa: E402
+from ocr_tagger import (AhoCorasick, AnnotationIndex, AnnotationJournal, BoxStore, DEFAULT_PRETAG_RULES, OCRCache,  # noqa: E402
+                        PageModel, PrefetchPipeline, PreTagger, ShardWriter, TiledOCR, bio_tokens,
+                        merge_tile_items, perf, reading_order, region_replaced_indices, run_export, tile_grid)
+
+
+def item(text, x1, y1, x2, y2, tag="O", score=0.9):
+    return {"text": text, "box": [[x1, y1], [x2, y2]], "tag": tag, "score": score}
+
+
+def test_aho_corasick_returns_smallest_value():
+    automaton = AhoCorasick()
+    automaton.add("東京", 2)
+    automaton.add("京都", 1)
+    automaton.add("都", 3)
+    automaton.build()
+    assert automaton.search("東京都庁") == 1  # 失敗遷移をたどって「京都」も見つかる
+    assert automaton.search("都内") == 3
+    assert automaton.search("大阪") is None
+    assert automaton.search("") is None
+
+
+def test_aho_corasick_matches_suffix_of_longer_word():
+    automaton = AhoCorasick()
+    automaton.add("abcd", 1)
+    automaton.add("bc", 0)
+    automaton.build()
+    assert automaton.search("xabcx") == 0
+    assert automaton.search("abd") is None
+
+
+def test_pretag_number_rule_requires_digit():
+    pretagger = PreTagger(DEFAULT_PRETAG_RULES)
+    assert pretagger.tag_text("1,234") == "Number"
+    assert pretagger.tag_text("２０２４/０１/３１") == "Number"  # 全角はNFKCでそろえてから照合する
+    for text in ("-", "...", "/", "--,--"):
+        assert pretagger.tag_text(text) is None
+
+
+def test_pretag_rule_priority_and_dictionary(capsys):
+    rules = [{"tag": "ORG", "patterns": [r"株式会社"]},
+             {"tag": "Product", "terms": ["ウィジェット"]},
+             {"tag": "Number", "patterns": [r"^(?=.*\d)[\d,.\-/]+$"]}]
+    pretagger = PreTagger(rules)
+    assert capsys.readouterr().out == ""  # 読み込みの報告は呼び出し側で行う
+    assert pretagger.summary() == "自動タグ付け: ルール3件, 辞書語1件"
+    assert pretagger.tag_text("株式会社ウィジェット") == "ORG"
+    assert pretagger.tag_text("ウィジェット") == "Product"
+
+
+def test_pretag_only_touches_untagged_boxes():
+    boxes = BoxStore.from_items([item("03-1234-5678", 0, 0, 10, 10),
+                                 item("100", 0, 20, 10, 30, tag="Price"),
+                                 item("請求書", 0, 40, 10, 50)])
+    changes = PreTagger(DEFAULT_PRETAG_RULES).apply(boxes)
+    assert changes == [[0, "O", "Phone"]]
+    assert [boxes.tag(i) for i in range(len(boxes))] == ["Phone", "Price", "O"]
+
+
+def test_box_store_find_and_retag():
+    boxes = BoxStore.from_items([item("a", 0, 0, 10, 10, score=0.5),
+                                 item("b", 0, 20, 10, 30, tag="Price", score=0.9),
+                                 item("c", 0, 40, 10, 50, score=0.95)])
+    assert boxes.find(tag="O") == [0, 2]
+    assert boxes.find(min_score=0.9) == [1, 2]
+    assert boxes.find(tag="O", max_score=0.6) == [0]
+    assert boxes.find(tag="Phone") == []
+    changes = boxes.retag([0, 1], "Total")
+    assert changes == [(0, boxes.tag_index["O"]), (1, boxes.tag_index["Price"])]
+    assert boxes.retag_all("Total", "O") == [(0, boxes.tag_index["Total"]), (1, boxes.tag_index["Total"])]
+    assert [boxes.tag(i) for i in range(len(boxes))] == ["O", "O", "O"]
+
+
+def test_box_store_scale_and_items():
+    boxes = BoxStore.from_items([item("a", 10, 20, 2, 4)])  # 座標の逆転はそろえる
+    boxes.append("b", 1, 1, 3, 5, tag="Price")
+    boxes.scale(2.0, 0.5)
+    assert list(boxes.items()) == [item("a", 4, 2, 20, 10), item("b", 2, 0.5, 6, 2.5, tag="Price", score=0.0)]
+    assert all(type(v) is float for v in boxes.item(0)["box"][0])  # JSONに書けるようにPythonの数値で返す
+    boxes.reset([item("c", 0, 0, 1, 1)])
+    assert len(boxes) == 1 and boxes.rect_ids.tolist() == [0]
+
+def test_merge_tile_items_joins_fragments_cut_at_tile_edge():
+    tiles = tile_grid(2400, 500, 1280, 160)  # x: 0-1280 と 1120-2400
+    left = [item("請求書番", 1000, 100, 1279, 130)]
+    right = [item("書番号", 1121, 100, 1400, 130)]
+    items = merge_tile_items([left, right], tiles, 160)
+    assert [(i["text"], i["box"]) for i in items] == [("請求書番号", [[1000, 100], [1400, 130]])]
+
+
+def test_merge_tile_items_keeps_neighbouring_words_apart():
+    tiles = tile_grid(2400, 500, 1280, 160)
+    left = [item("請求書", 1000, 100, 1150, 130), item("合計", 1140, 100, 1260, 130)]
+    right = [item("合計", 1141, 100, 1260, 130, score=0.8)]
+    items = merge_tile_items([left, right], tiles, 160)
+    assert [i["text"] for i in items] == ["請求書", "合計"]
+    assert items[1]["score"] == 0.9  # 二重に検出された方はスコアの高いものを残す
+
+
+def test_merge_tile_items_does_not_join_without_common_text():
+    tiles = tile_grid(2400, 500, 1280, 160)
+    left = [item("合計", 1100, 100, 1279, 130)]
+    right = [item("金額", 1121, 100, 1300, 130)]
+    items = merge_tile_items([left, right], tiles, 160)
+    assert sorted(i["text"] for i in items) == ["合計", "金額"]
+    # タイルの情報がなければ断片はつなげない
+    items = merge_tile_items([[item("請求書番", 1000, 100, 1279, 130)], [item("書番号", 1121, 100, 1400, 130)]])
+    assert len(items) == 2
+
+
+def test_merge_tile_items_vertical_fragments():
+    tiles = tile_grid(500, 2400, 1280, 160)  # y: 0-1280 と 1120-2400
+    top = [item("東京都千", 100, 1000, 130, 1279)]
+    bottom = [item("都千代田区", 100, 1121, 130, 1500)]
+    items = merge_tile_items([top, bottom], tiles, 160)
+    assert [i["text"] for i in items] == ["東京都千代田区"]
+
+
+def make_model():
+    model = PageModel()
+    model.image_path = "page.png"
+    model.set_boxes(BoxStore.from_items([item("請求書", 10, 10, 110, 40),
+                                         item("03-1234-5678", 10, 60, 210, 90),
+                                         item("合計", 10, 110, 60, 140)]))
+    return model
+
+
+def tags(model):
+    return [model.boxes.tag(i) for i in range(len(model.boxes))]
+
+
+def test_page_model_undo_redo():
+    model = make_model()
+    model.apply_tag([0, 2], "Title")
+    model.perform({"texts": [[2, "合計", "合計金額"]]})
+    assert tags(model) == ["Title", "O", "Title"]
+    assert model.undo() == ({"texts": [[2, "合計", "合計金額"]]}, [2])
+    assert model.boxes.texts[2] == "合計"
+    model.undo()
+    assert tags(model) == ["O", "O", "O"]
+    assert model.undo() is None
+    model.redo()
+    assert tags(model) == ["Title", "O", "Title"]
+    model.apply_tag([1], "Phone")  # 新しい操作でRedoの履歴は消える
+    assert model.redo() is None
+    assert tags(model) == ["Title", "Phone", "Title"]
+
+
+def test_page_model_replace_updates_hit_test():
+    model = make_model()
+    assert model.hit_test(20, 20) == 0
+    old_items = list(model.boxes.items())
+    model.perform({"replace": [[[0, old_items[0]], [2, old_items[2]]], [item("領収書", 300, 300, 400, 330)]]})
+    assert [i["text"] for i in model.boxes.items()] == ["03-1234-5678", "領収書"]
+    assert model.hit_test(20, 20) is None
+    assert model.hit_test(350, 310) == 1
+    model.undo()
+    assert list(model.boxes.items()) == old_items  # 削除した矩形は元の位置に戻る
+    assert model.hit_test(20, 20) == 0
+    model.redo()
+    assert [i["text"] for i in model.boxes.items()] == ["03-1234-5678", "領収書"]
+
+
+def test_page_model_snapshot_keeps_recent_history():
+    model = make_model()
+    for n in range(ocr_tagger.JOURNAL_HISTORY_LIMIT + 20):
+        model.apply_tag([n % 3], "Title" if n % 2 == 0 else "O")
+    snapshot = model.snapshot()
+    assert len(snapshot["undo"]) == ocr_tagger.JOURNAL_HISTORY_LIMIT
+    assert snapshot["undo"] == model.undo_stack[-ocr_tagger.JOURNAL_HISTORY_LIMIT:]
+
+
+def test_journal_replay_restores_page(tmp_path):
+    model = make_model()
+    journal = AnnotationJournal(model.image_path, str(tmp_path))
+    journal.compact(model.snapshot())
+    journal.append({"op": "do", "step": model.apply_tag([0], "Title")})
+    step = {"texts": [[1, "03-1234-5678", "03-1234-5679"]]}
+    model.perform(step)
+    journal.append({"op": "do", "step": step})
+    for op in ("undo", "redo", "undo"):
+        getattr(model, op)()
+        journal.append({"op": op})
+    journal.close()
+
+    restored = PageModel()
+    restored.restore(*AnnotationJournal(model.image_path, str(tmp_path)).load())
+    assert list(restored.boxes.items()) == list(model.boxes.items())
+    assert restored.undo_stack == model.undo_stack
+    assert restored.redo_stack == model.redo_stack
+    assert restored.hit_test(20, 20) == 0
+
+
+def test_journal_tracks_unsaved_work(tmp_path):
+    model = make_model()
+    journal = AnnotationJournal(model.image_path, str(tmp_path))
+    journal.compact(model.snapshot())
+    journal.close()
+    assert not AnnotationJournal(model.image_path, str(tmp_path)).has_unsaved_work()
+    journal.append({"op": "do", "step": model.apply_tag([0], "Title")})
+    journal.compact(model.snapshot())  # まとめた後も未保存のまま
+    journal.close()
+    assert AnnotationJournal(model.image_path, str(tmp_path)).has_unsaved_work()
+    journal.unsaved = False
+    journal.compact(model.snapshot())
+    journal.close()
+    assert not AnnotationJournal(model.image_path, str(tmp_path)).has_unsaved_work()
+
+
+class StubEngine:
+    # 切り出した画像のどこでも同じ位置に1行だけ検出したことにする
+    lang = "japan"
+    use_angle_cls = False
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.calls = 0
+
+    def config(self, cls=True):
+        return {"lang": self.lang, "cls": cls}
+
+    def ocr_image(self, image, cls=True):
+        self.calls += 1
+        return [[[[[10, 10], [100, 10], [100, 40], [10, 40]], ["請求書", 0.9]]]]
+
+
+class InlinePool:
+    # ワーカープロセスの代わりに同じプロセスで順に実行する
+    def map(self, func, iterable):
+        return list(map(func, iterable))
+
+
+def test_tiled_ocr_runs_tiles_and_records_stats(tmp_path, monkeypatch):
+    path = str(tmp_path / "page.png")
+    Image.new("RGB", (2400, 500), "white").save(path)
+    engine = StubEngine(cache=OCRCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(ocr_tagger, "_batch_engine", engine)
+    monkeypatch.setattr(ocr_tagger, "_tile_image", None)
+    tiled = TiledOCR(engine, workers=2, tile_size=1280, overlap=160, min_pixels=0, pool=InlinePool())
+    assert tiled.needs_tiling(path)
+    count = perf.stats.get("ocr.tiled", [0])[0]
+
+    lines = tiled.ocr(path)[0]
+    boxes = [(line[0][0], line[0][2], line[1][0]) for line in lines]
+    assert boxes == [([10, 10], [100, 40], "請求書"), ([1130, 10], [1220, 40], "請求書")]
+    assert engine.calls == 2
+    assert tiled.last_stats["tiles"] == 2
+    assert tiled.last_stats["raw_boxes"] == 2
+    assert tiled.last_stats["boxes"] == 2
+    assert perf.stats["ocr.tiled"][0] == count + 1
+
+    # 2回目はキャッシュから返し、タイルのOCRは行わない
+    assert tiled.ocr(path)[0] == lines
+    assert engine.calls == 2
+    tiled.close()
+
+
+def test_prefetch_budget_keeps_ocr_results(tmp_path):
+    paths = []
+    for i in range(6):
+        path = str(tmp_path / f"page{i}.png")
+        Image.new("RGB", (1000, 1000), "white").save(path)
+        paths.append(path)
+    ocr_calls = []
+    notified = []  # GUIではUIスレッドで呼ばれるので、テストでも待ってから順に呼ぶ
+    executor = ThreadPoolExecutor(max_workers=1)
+    pipeline = PrefetchPipeline(executor, depth=3, max_bytes=5 * 1024 * 1024,
+                                ocr_func=lambda path, cls: ocr_calls.append(path) or [[]],
+                                watch=lambda future, callback: notified.append((future, callback)))
+
+    def settle():
+        for image_future, ocr_future in list(pipeline.pages.values()):
+            if image_future is not None:
+                image_future.exception()
+            ocr_future.result()
+        while notified:
+            future, callback = notified.pop(0)
+            callback(future)
+
+    pipeline.prefetch(paths[1:])
+    settle()
+    decoded = [path for path, (image_future, _) in pipeline.pages.items() if image_future is not None]
+    assert decoded == [paths[1]]  # 1MPのピラミッドは約4MBなので1枚だけ残る
+    for index in range(1, 4):
+        image_future, ocr_future = pipeline.take(paths[index])
+        assert ocr_future.result() == [[]]
+        assert (image_future is not None) == (index == 1)
+        pipeline.prefetch(paths[index + 1:])
+        settle()
+    assert sorted(ocr_calls) == paths[1:]  # どのページもOCRは1回だけ
+    pipeline.shutdown()
+    executor.shutdown()
+
+
+def write_page(path, texts, tag="O"):
+    data = {"image_path": None, "scale": 1.0,
+            "items": [item(text, 0, i * 20, 100, i * 20 + 10, tag=tag) for i, text in enumerate(texts)]}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def test_annotation_index_ingest_and_search(tmp_path):
+    folder = tmp_path / "saved"
+    folder.mkdir()
+    write_page(str(folder / "a.json"), ["請求書番号", "合計金額"])
+    write_page(str(folder / "b.json"), ["請求先"], tag="ORG")
+    with open(folder / "pretag_rules.json", "w", encoding="utf-8") as f:
+        json.dump(DEFAULT_PRETAG_RULES, f)  # リストのJSON
+    with open(folder / "tags.json", "w", encoding="utf-8") as f:
+        json.dump({"O": "gray"}, f)  # itemsのない辞書
+    index = AnnotationIndex(str(tmp_path / "annotations.db"))
+
+    stats = index.ingest_dir(str(folder))
+    assert stats == {"added": 2, "updated": 0, "unchanged": 0, "removed": 0, "failed": 2}
+    for fts in sorted({index.fts, False}):  # trigramが使えれば索引とLIKEの両方で同じ結果になる
+        index.fts = fts
+        assert [row[3] for row in index.search("請求書")] == ["請求書番号"]
+        assert [row[3] for row in index.search("請求")] == ["請求書番号", "請求先"]  # 3文字未満はLIKE
+        assert [row[3] for row in index.search("請求", tag="ORG")] == ["請求先"]
+
+    assert index.ingest_dir(str(folder))["unchanged"] == 2
+    write_page(str(folder / "a.json"), ["領収書"])
+    os.utime(folder / "a.json", (1, 1))  # 内容と同じ大きさでも更新時刻で取り込み直す
+    os.remove(folder / "b.json")
+    stats = index.ingest_dir(str(folder))
+    assert (stats["updated"], stats["removed"]) == (1, 1)
+    assert [row[3] for row in index.search("書")] == ["領収書"]
+    assert index.tag_counts() == [("O", 1)]
+    index.close()
+
+
+def test_reading_order_groups_lines():
+    items = [item("右下", 200, 52, 260, 78), item("左上", 10, 10, 60, 40), item("左下", 10, 50, 60, 80),
+             item("右上", 200, 5, 260, 35)]
+    assert [i["text"] for i in reading_order(items)] == ["左上", "右上", "左下", "右下"]
+
+
+def test_bio_tokens_units():
+    items = [item("株式 会社", 0, 0, 10, 10, tag="ORG"), item("様", 20, 0, 30, 10)]
+    assert bio_tokens(items) == (["株", "式", "会", "社", "様"], ["B-ORG", "I-ORG", "I-ORG", "I-ORG", "O"])
+    assert bio_tokens(items, unit="box") == (["株式 会社", "様"], ["B-ORG", "O"])
+
+
+def test_shard_writer_rolls_over(tmp_path):
+    writer = ShardWriter(str(tmp_path), "train", "jsonl", shard_size=2)
+    for n in range(5):
+        writer.write(f"{n}\n")
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["train-00000.jsonl", "train-00001.jsonl", "train-00002.jsonl"]
+    assert (tmp_path / "train-00002.jsonl").read_text(encoding="utf-8") == "4\n"
+
+
+def test_export_skips_malformed_files(tmp_path):
+    folder = tmp_path / "saved"
+    folder.mkdir()
+    write_page(str(folder / "a.json"), ["請求書"], tag="Title")
+    write_page(str(folder / "b.json"), ["合計"])
+    with open(folder / "rules.json", "w", encoding="utf-8") as f:
+        json.dump(DEFAULT_PRETAG_RULES, f)
+    with open(folder / "broken.json", "w", encoding="utf-8") as f:
+        json.dump({"items": [{"box": [[0, 0], [1, 1]], "text": "x"}]}, f)  # tagがない
+
+    stats = run_export(str(folder), str(tmp_path / "out"), skip_untagged=True)
+    assert (stats["written"], stats["skipped"], stats["shards"]) == (1, 3, 1)
+    with open(tmp_path / "out" / "train-00000.jsonl", encoding="utf-8") as f:
+        record = json.loads(f.readline())
+    assert (record["tokens"], record["labels"]) == (["請", "求", "書"], ["B-Title", "I-Title", "I-Title"])
+
+
+def test_region_replaces_boxes_inside_and_overlapping_new_boxes():
+    items = [item("請求書", 10, 10, 110, 40),       # 選択範囲にすべて入る
+             item("合計金額 12,000円", 90, 60, 400, 90),  # 選択範囲には一部だけ入り、新しい矩形と重なる
+             item("備考", 300, 10, 360, 40)]          # 範囲外
+    region = (0, 0, 150, 100)
+    new_items = [item("請求書", 12, 11, 108, 39), item("合計金額", 92, 61, 158, 89)]  # 余白の分だけはみ出す
+    assert region_replaced_indices(items, region, new_items) == [0, 1]
+    assert region_replaced_indices(items, region, []) == [0]
+
+
+def test_find_regressions_flags_slow_hot_paths():
+    baseline = {"hit_test[1000]": {"p50_ms": 0.003, "peak_mb": 1.0}, "save[1000]": {"p50_ms": 25.0, "peak_mb": 1.0}}
+    noise = {"hit_test[1000]": {"p50_ms": 0.004, "peak_mb": 1.5}, "save[1000]": {"p50_ms": 28.0, "peak_mb": 1.0}}
+    assert find_regressions(noise, baseline, 0.25) == []
+    slow = {"hit_test[1000]": {"p50_ms": 0.3, "peak_mb": 1.0}, "ui_click[1000]": {"p50_ms": 9.0, "peak_mb": 1.0}}
+    assert find_regressions(slow, baseline, 0.25) == ["hit_test[1000]: p50 0.003ms -> 0.300ms"]